@@ -0,0 +1,184 @@
+"""Transcoding benchmark for the conversion path in bot.py.
+
+Generates synthetic fixtures with ffmpeg's lavfi sources, runs every preset
+through run_ffmpeg_command (no Telegram involved) and reports wall time,
+CPU time, peak RSS and output size as JSON.
+
+    python benchmark.py                              # run, write benchmark_results.json
+    python benchmark.py --save-baseline base.json    # record a baseline
+    python benchmark.py --baseline base.json         # flag regressions (exit code 1)
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import asyncio
+import resource
+import subprocess
+
+# The bot's runtime state (session journal, learned encode costs) must not
+# pick up benchmark runs; set before bot reads its config at import
+os.environ["JOURNAL_FILE"] = ""
+os.environ["COST_MODEL_FILE"] = ""
+
+import bot
+
+FIXTURE_DIR = "bench_fixtures"
+DEFAULT_DURATIONS = [30, 300]
+DEFAULT_THRESHOLD = 0.15
+
+# name -> ffmpeg arguments that produce it; "{d}" is replaced by the duration
+FIXTURES = {
+    'tone.mp3': ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=44100", "-ac", "2",
+                 "-c:a", "libmp3lame", "-b:a", "192k"],
+    'tone.m4a': ["-f", "lavfi", "-i", "sine=frequency=660:sample_rate=44100", "-ac", "2",
+                 "-c:a", "aac", "-b:a", "128k"],
+    'noise.wav': ["-f", "lavfi", "-i", "anoisesrc=color=pink:sample_rate=48000", "-ac", "2"],
+    'noise.flac': ["-f", "lavfi", "-i", "anoisesrc=color=brown:sample_rate=48000", "-ac", "2"],
+    'clip.mp4': ["-f", "lavfi", "-i", "testsrc=size=640x360:rate=25", "-f", "lavfi", "-i", "sine=frequency=880",
+                 "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-shortest"],
+    'clip.mkv': ["-f", "lavfi", "-i", "testsrc2=size=640x360:rate=25", "-f", "lavfi", "-i", "anoisesrc=color=white",
+                 "-c:v", "mpeg4", "-c:a", "libvorbis", "-shortest"],
+}
+VIDEO_EXTENSIONS = ('.mp4', '.mkv')
+
+EFFECT_PRESETS = {
+    'bass': {'bass_boost': True},
+    '8d': {'eight_d_audio': True},
+    'normalize': {'normalize': True},
+    'speed-1.5': {'speed': 1.5},
+    'all-effects': {'bass_boost': True, 'eight_d_audio': True, 'normalize': True, 'speed': 1.25},
+    'trim': {'trim': True},
+}
+
+def presets():
+    """Every format at every bitrate, then each effect on the default MP3/192 output."""
+    for fmt in bot.AUDIO_FORMATS:
+        for bitrate in bot.BITRATES:
+            yield f"{fmt}-{bitrate}", {'format': fmt, 'bitrate': bitrate}
+    for name, settings in EFFECT_PRESETS.items():
+        yield name, settings
+
+def make_fixtures(durations):
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    fixtures = []
+    for duration in durations:
+        for name, args in FIXTURES.items():
+            base, ext = os.path.splitext(name)
+            path = os.path.join(FIXTURE_DIR, f"{base}_{duration}s{ext}")
+            if not os.path.exists(path):
+                cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"] + args + ["-t", str(duration), "-y", path]
+                subprocess.run(cmd, check=True)
+            fixtures.append((path, duration))
+    return fixtures
+
+def run_case(path, duration, settings):
+    """Runs one conversion in this process and returns its measurements."""
+    session = bot.Session(
+        user_id=0,
+        unique_id=f"bench_{os.getpid()}",
+        file_id=None,
+        file_unique_id=None,
+        original_name=os.path.basename(path),
+        input_path=path,
+        duration=float(duration),
+        is_video=path.endswith(VIDEO_EXTENSIONS),
+    )
+    session.input_file = path
+    for field, value in settings.items():
+        if field == 'trim':
+            session.trim_start = duration // 4
+            session.trim_end = duration * 3 // 4
+        else:
+            setattr(session, field, value)
+
+    started = time.perf_counter()
+    output_path, thumb_path, _ = asyncio.run(bot.run_ffmpeg_command(session))
+    wall = time.perf_counter() - started
+
+    # Every ffmpeg/ffprobe this case ran is a waited-for child of this process
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    size = os.path.getsize(output_path)
+    bot.cleanup_files(output_path, thumb_path)
+    return {
+        'wall': round(wall, 3),
+        'cpu': round(usage.ru_utime + usage.ru_stime, 3),
+        'peak_rss_kb': usage.ru_maxrss,
+        'output_bytes': size,
+    }
+
+def measure(path, duration, preset, settings):
+    """Runs a case in a fresh interpreter so CPU and peak RSS are its own."""
+    spec = json.dumps({'path': path, 'duration': duration, 'settings': settings})
+    result = subprocess.run([sys.executable, __file__, "--case", spec], stdout=subprocess.PIPE, text=True)
+    case = {'fixture': os.path.basename(path), 'preset': preset}
+    if result.returncode != 0:
+        case['error'] = True
+        return case
+    case.update(json.loads(result.stdout.strip().splitlines()[-1]))
+    return case
+
+def compare(cases, baseline, threshold):
+    """Returns the cases whose wall or CPU time grew by more than `threshold`."""
+    previous = {(c['fixture'], c['preset']): c for c in baseline.get('cases', [])}
+    regressions = []
+    for case in cases:
+        before = previous.get((case['fixture'], case['preset']))
+        if not before or case.get('error') or before.get('error'):
+            continue
+        for metric in ('wall', 'cpu'):
+            # Ignore noise on runs too short to time reliably
+            if before[metric] >= 0.05 and case[metric] > before[metric] * (1 + threshold):
+                regressions.append({
+                    'fixture': case['fixture'], 'preset': case['preset'], 'metric': metric,
+                    'baseline': before[metric], 'current': case[metric],
+                })
+    return regressions
+
+def ffmpeg_version():
+    result = subprocess.run(["ffmpeg", "-version"], stdout=subprocess.PIPE, text=True)
+    return result.stdout.splitlines()[0] if result.stdout else "unknown"
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the bot's ffmpeg conversion path.")
+    parser.add_argument("--durations", type=int, nargs="+", default=DEFAULT_DURATIONS, help="fixture lengths in seconds")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to write the JSON report")
+    parser.add_argument("--baseline", help="baseline report to compare against")
+    parser.add_argument("--save-baseline", help="also write this run as a baseline")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD, help="allowed slowdown, e.g. 0.15 = 15%%")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        spec = json.loads(args.case)
+        print(json.dumps(run_case(spec['path'], spec['duration'], spec['settings'])))
+        return
+
+    cases = []
+    for path, duration in make_fixtures(args.durations):
+        for preset, settings in presets():
+            case = measure(path, duration, preset, settings)
+            cases.append(case)
+            status = "ERROR" if case.get('error') else f"{case['wall']:.2f}s wall, {case['cpu']:.2f}s cpu"
+            print(f"{case['fixture']:<20} {preset:<12} {status}")
+
+    report = {'ffmpeg': ffmpeg_version(), 'cpu_count': os.cpu_count(), 'cases': cases}
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = compare(cases, json.load(f), args.threshold)
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {regression['fixture']} {regression['preset']} {regression['metric']}: "
+              f"{regression['baseline']}s -> {regression['current']}s")
+    if report.get('regressions') or any(case.get('error') for case in cases):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
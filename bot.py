@@ -1,70 +1,1599 @@
 import os
+import sys
 import logging
 import asyncio
 import subprocess
 import time
 import re
-import requests
-from threading import Thread
-from flask import Flask
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ChatMember
+import json
+import hashlib
+import datetime
+import zipfile
+import shutil
+import signal
+import socket
+import sqlite3
+import contextlib
+import httpx
+from collections import OrderedDict
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
+from telegram import (
+    Update, InlineKeyboardButton, InlineKeyboardMarkup, InputMediaDocument, ChatMember, CallbackQuery, Chat, Message, User,
+)
 from telegram.constants import ParseMode
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.error import RetryAfter
+from telegram.ext import (
+    Application, BaseRateLimiter, CallbackContext, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes,
+)
+from telegram.request import HTTPXRequest
 
-# --- FLASK KEEP-ALIVE SERVER ---
-app = Flask('')
+# --- HTTP SERVER ---
+# Runs on the bot's own event loop: health, stats and metrics routes, plus
+# the Telegram webhook endpoint when WEBHOOK_URL (or Render's external URL)
+# is set. Without one the bot falls back to long polling.
+PORT = int(os.environ.get("PORT", 8080))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL") or os.getenv("RENDER_EXTERNAL_URL")
 
-@app.route('/')
-def home():
-    return "Bot is Running! 🚀"
+async def home(request):
+    return web.Response(text="Bot is Running! 🚀")
 
-def run_flask():
-    port = int(os.environ.get("PORT", 8080))
-    app.run(host='0.0.0.0', port=port)
+async def stats(request):
+    return web.json_response({
+        **scheduler.stats(),
+        'sessions': len(user_sessions),
+        'expired_sessions': user_sessions.expired,
+        'subscription_cache': subscription_cache.stats(),
+        'pcm_cache': pcm_cache.stats(),
+        'outbound': outbound_limiter.stats(),
+        'storage': storage.stats(),
+        'cost_model': cost_model.stats(),
+        'job_queue': await asyncio.to_thread(job_queue.stats) if job_queue else None,
+    })
 
-def self_ping():
-    while True:
-        try:
-            render_url = os.environ.get("RENDER_EXTERNAL_URL") 
-            if render_url:
-                requests.get(render_url)
-            else:
-                requests.get(f"http://127.0.0.1:{os.environ.get('PORT', 8080)}")
-        except:
-            pass
-        time.sleep(600) 
+async def metrics(request):
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
 
-def start_keep_alive():
-    t1 = Thread(target=run_flask)
-    t1.daemon = True
-    t1.start()
-    t2 = Thread(target=self_ping)
-    t2.daemon = True
-    t2.start()
+def build_web_app(application):
+    web_app = web.Application()
+    web_app.router.add_get('/', home)
+    web_app.router.add_get('/stats', stats)
+    web_app.router.add_get('/metrics', metrics)
+
+    async def telegram_webhook(request):
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=403)
+        update = Update.de_json(await request.json(), application.bot)
+        # Once stop() has begun, a queued update would never be processed (and
+        # would hang its queue join); a 503 makes Telegram deliver it again later
+        if not application.running:
+            return web.Response(status=503)
+        await application.update_queue.put(update)
+        return web.Response()
+
+    web_app.router.add_post(f'/{WEBHOOK_PATH}', telegram_webhook)
+    return web_app
+
+async def self_ping():
+    """Keeps a free instance awake while polling; webhook traffic does that itself."""
+    url = WEBHOOK_URL or f"http://127.0.0.1:{PORT}"
+    async with httpx.AsyncClient(timeout=30) as client:
+        while True:
+            await asyncio.sleep(600)
+            try:
+                await client.get(url)
+            except Exception:
+                pass
 
 # --- CONFIGURATION ---
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
+# Unguessable webhook path and secret header, derived from the token unless set
+WEBHOOK_PATH = hashlib.sha256(f"path:{BOT_TOKEN}".encode()).hexdigest()[:32]
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"secret:{BOT_TOKEN}".encode()).hexdigest()
 FORCE_SUB_CHANNEL = os.getenv("FORCE_SUB_CHANNEL") 
 
-TEMP_DIR = "temp_audio"
+# Self-hosted Bot API server (telegram-bot-api --local) sharing our
+# filesystem, e.g. http://localhost:8081. Its get_file returns a local path
+# that is read in place, uploads go as file:// paths, and files up to 2GB
+# are allowed instead of the cloud API's limits.
+BOT_API_URL = os.getenv("BOT_API_URL")
+LOCAL_BOT_API = bool(BOT_API_URL)
+LOCAL_FILE_TIMEOUT = 600  # the server fetches the whole file before get_file returns
+MAX_FILE_SIZE_MB = min(int(os.getenv("MAX_FILE_SIZE_MB", 2000 if LOCAL_BOT_API else 200)), 2000)
+
+# Must be the same directory for the bot and any JOB_QUEUE workers
+TEMP_DIR = os.path.normpath(os.getenv("TEMP_DIR", "temp_audio"))
 os.makedirs(TEMP_DIR, exist_ok=True)
+# Optional tmpfs (e.g. /dev/shm/audio_bot) for small jobs, see STORAGE
+RAM_DIR = os.getenv("RAM_DIR") and os.path.normpath(os.getenv("RAM_DIR"))
+if RAM_DIR:
+    os.makedirs(RAM_DIR, exist_ok=True)
+STORAGE_DIRS = [TEMP_DIR] + ([RAM_DIR] if RAM_DIR else [])
 
 AUDIO_FORMATS = {'mp3': 'MP3', 'm4a': 'M4A', 'wav': 'WAV', 'ogg': 'OGG', 'flac': 'FLAC', 'aac': 'AAC'}
 BITRATES = {'64': '64k', '128': '128k', '192': '192k', '256': '256k', '320': '320k'}
+# Containers that can carry embedded cover art through a stream copy
+COVER_ART_FORMATS = ('mp3', 'flac', 'm4a')
+
+# --- METRICS ---
+# Served by the HTTP server at /metrics. Gauges backed by set_function are
+# only evaluated when Prometheus scrapes.
+UPLOADS_TOTAL = Counter('bot_uploads_total', 'Files received from users', ['kind'])
+DOWNLOAD_SECONDS = Histogram('bot_download_seconds', 'Telegram download time',
+                             buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+PROBE_SECONDS = Histogram('bot_probe_seconds', 'ffprobe time', buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+ENCODE_SECONDS = Histogram('bot_encode_seconds', 'ffmpeg render time', ['format', 'effects'],
+                           buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+UPLOAD_SECONDS = Histogram('bot_upload_seconds', 'Result upload time', buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120))
+JOB_SECONDS = Histogram('bot_job_seconds', 'Time from START PROCESSING to result delivered',
+                        buckets=(1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800))
+FFMPEG_ACTIVE = Gauge('bot_ffmpeg_processes', 'Running ffmpeg processes')
+BOT_API_ERRORS = Counter('bot_api_errors_total', 'Failed Bot API requests', ['reason'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Exceptions escaping update handlers')
+Gauge('bot_sessions', 'Live user sessions').set_function(lambda: len(user_sessions))
+Gauge('bot_queue_depth', 'Jobs waiting for an ffmpeg slot').set_function(lambda: len(scheduler.pending))
+
+def temp_dir_usage():
+    total = 0
+    for entry in os.scandir(TEMP_DIR):
+        try:
+            total += entry.stat().st_size
+        except OSError:
+            pass
+    return total
+
+Gauge('bot_temp_dir_bytes', f'Bytes used in {TEMP_DIR}').set_function(temp_dir_usage)
+
+def effects_label(session):
+    effects = [name for name, on in (
+        ('bass', session.bass_boost), ('8d', session.eight_d_audio),
+        ('normalize', session.normalize), ('speed', session.speed != 1.0),
+    ) if on]
+    return '+'.join(effects) or 'none'
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that counts failed Bot API calls by status or error type."""
+
+    async def do_request(self, *args, **kwargs):
+        try:
+            code, payload = await super().do_request(*args, **kwargs)
+        except Exception as e:
+            BOT_API_ERRORS.labels(type(e).__name__).inc()
+            raise
+        if code >= 400:
+            BOT_API_ERRORS.labels(str(code)).inc()
+        return code, payload
+
+# --- OUTBOUND QUEUE ---
+# Every chat-bound Bot API call goes through OutboundLimiter (PTB's
+# rate_limiter hook). It keeps under a global and a per-chat send rate,
+# sends one request per chat at a time, and picks result uploads before
+# plain messages before cosmetic edits. An edit to a message that still
+# has an unsent edit replaces it, so a burst of menu toggles costs one
+# request. On a 429 the chat waits out retry_after and the request is
+# retried.
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", 25))
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", 1))
+OUTBOUND_GROUP_RATE = 20 / 60
+OUTBOUND_MAX_RETRIES = 3
+
+PRIORITY_UPLOAD, PRIORITY_MESSAGE, PRIORITY_EDIT = 0, 1, 2
+ENDPOINT_PRIORITY = {
+    'sendAudio': PRIORITY_UPLOAD, 'sendDocument': PRIORITY_UPLOAD, 'sendMediaGroup': PRIORITY_UPLOAD,
+    'sendVoice': PRIORITY_UPLOAD, 'sendVideo': PRIORITY_UPLOAD, 'sendPhoto': PRIORITY_UPLOAD,
+    'sendMessage': PRIORITY_MESSAGE, 'deleteMessage': PRIORITY_MESSAGE, 'copyMessage': PRIORITY_MESSAGE,
+    'forwardMessage': PRIORITY_MESSAGE,
+    'editMessageText': PRIORITY_EDIT, 'editMessageReplyMarkup': PRIORITY_EDIT, 'editMessageCaption': PRIORITY_EDIT,
+}
+
+OUTBOUND_COALESCED = Counter('bot_outbound_coalesced_total', 'Message edits replaced by a newer edit before sending')
+OUTBOUND_RETRIES = Counter('bot_outbound_retry_after_total', 'Requests retried after a 429 retry_after')
+
+class Outbound:
+    def __init__(self, seq, priority, chat_id, edit_key, call):
+        self.seq = seq
+        self.priority = priority
+        self.chat_id = chat_id
+        self.edit_key = edit_key
+        self.call = call  # (callback, args, kwargs)
+        self.futures = [asyncio.get_running_loop().create_future()]
+        self.attempts = 0
+
+class OutboundLimiter(BaseRateLimiter):
+    def __init__(self, global_rate, chat_rate, group_rate, max_retries):
+        self.global_interval = 1 / global_rate
+        self.chat_interval = 1 / chat_rate
+        self.group_interval = 1 / group_rate
+        self.max_retries = max_retries
+        self.pending = []
+        self._edits = {}       # (chat_id, message_id) -> unsent Outbound
+        self._chat_ready = {}  # chat_id -> monotonic time it may be sent to again
+        self._in_flight = set()
+        self._next_send = 0.0
+        self._seq = 0
+        self.coalesced = 0
+        self._wakeup = None
+        self._task = None
+
+    async def initialize(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch())
+
+    async def shutdown(self):
+        if self._task:
+            self._task.cancel()
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = ENDPOINT_PRIORITY.get(endpoint)
+        chat_id = data.get('chat_id')
+        if priority is None or chat_id is None or self._task is None:
+            return await callback(*args, **kwargs)
+
+        edit_key = (chat_id, data.get('message_id')) if priority == PRIORITY_EDIT else None
+        entry = self._edits.get(edit_key) if edit_key else None
+        if entry:
+            # Only the newest state of the message is worth sending
+            entry.call = (callback, args, kwargs)
+            future = asyncio.get_running_loop().create_future()
+            entry.futures.append(future)
+            self.coalesced += 1
+            OUTBOUND_COALESCED.inc()
+        else:
+            self._seq += 1
+            entry = Outbound(self._seq, priority, chat_id, edit_key, (callback, args, kwargs))
+            future = entry.futures[0]
+            self.pending.append(entry)
+            if edit_key:
+                self._edits[edit_key] = entry
+            self._wakeup.set()
+        return await future
+
+    def _pick(self, now):
+        """Most urgent entry whose chat is free and ready, and when to look again if none is."""
+        best, wake_at = None, None
+        for entry in self.pending:
+            if entry.chat_id in self._in_flight:
+                continue
+            ready = self._chat_ready.get(entry.chat_id, 0)
+            if ready > now:
+                wake_at = ready if wake_at is None else min(wake_at, ready)
+            elif best is None or (entry.priority, entry.seq) < (best.priority, best.seq):
+                best = entry
+        return best, wake_at
+
+    async def _dispatch(self):
+        while True:
+            now = time.monotonic()
+            if self._next_send > now:
+                await asyncio.sleep(self._next_send - now)
+                now = time.monotonic()
+            entry, wake_at = self._pick(now)
+            if entry is None:
+                self._wakeup.clear()
+                try:
+                    timeout = None if wake_at is None else wake_at - now
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self.pending.remove(entry)
+            if entry.edit_key:
+                self._edits.pop(entry.edit_key, None)
+            if all(future.done() for future in entry.futures):
+                continue  # every caller gave up waiting
+            self._next_send = now + self.global_interval
+            interval = self.group_interval if str(entry.chat_id).startswith('-') else self.chat_interval
+            self._chat_ready[entry.chat_id] = now + interval
+            self._in_flight.add(entry.chat_id)
+            asyncio.create_task(self._send(entry))
+
+    async def _send(self, entry):
+        callback, args, kwargs = entry.call
+        try:
+            result = await callback(*args, **kwargs)
+        except RetryAfter as e:
+            entry.attempts += 1
+            self._chat_ready[entry.chat_id] = time.monotonic() + e.retry_after
+            if entry.attempts <= self.max_retries:
+                OUTBOUND_RETRIES.inc()
+                logger.warning(f"Flood limit for chat {entry.chat_id}, retrying in {e.retry_after}s")
+                self._requeue(entry)
+            else:
+                self._resolve(entry, error=e)
+        except Exception as e:
+            self._resolve(entry, error=e)
+        else:
+            self._resolve(entry, result=result)
+        finally:
+            self._in_flight.discard(entry.chat_id)
+            if len(self._chat_ready) > 10000:
+                now = time.monotonic()
+                self._chat_ready = {c: t for c, t in self._chat_ready.items() if t > now}
+            self._wakeup.set()
+
+    def _requeue(self, entry):
+        newer = self._edits.get(entry.edit_key) if entry.edit_key else None
+        if newer:
+            # The message was edited again meanwhile; that edit answers these callers too
+            newer.futures.extend(entry.futures)
+            return
+        self.pending.append(entry)
+        if entry.edit_key:
+            self._edits[entry.edit_key] = entry
+
+    def _resolve(self, entry, result=None, error=None):
+        for future in entry.futures:
+            if future.done():
+                continue
+            if error:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'in_flight': len(self._in_flight),
+            'coalesced': self.coalesced,
+        }
+
+outbound_limiter = OutboundLimiter(OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_MAX_RETRIES)
+Gauge('bot_outbound_pending', 'Bot API requests waiting in the outbound queue').set_function(
+    lambda: len(outbound_limiter.pending))
+
+# --- SESSION JOURNAL ---
+# Sessions (settings, input paths, Telegram file ids) and whether a job was
+# running are mirrored into a SQLite journal in WAL mode. On startup the
+# bot restores them, so inputs still on disk are reused instead of
+# re-downloaded, and interrupted jobs are started again (or, with
+# JOB_QUEUE, reattached to the worker job) with a note to the user.
+JOURNAL_FILE = os.getenv("JOURNAL_FILE", "journal.db")
+
+class SessionJournal:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            " user_id INTEGER PRIMARY KEY, unique_id TEXT NOT NULL, state TEXT NOT NULL, data TEXT NOT NULL,"
+            " chat_id INTEGER, message_id INTEGER, updated_at REAL NOT NULL)"
+        )
+
+    def save(self, session, message=None):
+        """`message` is the status message of a job that is starting, if any."""
+        chat_id, message_id = (message.chat_id, message.message_id) if message else (None, None)
+        self.db.execute(
+            "INSERT INTO sessions (user_id, unique_id, state, data, chat_id, message_id, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET"
+            " unique_id = excluded.unique_id, state = excluded.state, data = excluded.data,"
+            " chat_id = COALESCE(excluded.chat_id, chat_id), message_id = COALESCE(excluded.message_id, message_id),"
+            " updated_at = excluded.updated_at",
+            (session.user_id, session.unique_id, 'processing' if session.processing else 'idle',
+             json.dumps(session.to_journal()), chat_id, message_id, time.time())
+        )
+
+    def delete(self, session):
+        self.db.execute("DELETE FROM sessions WHERE user_id = ? AND unique_id = ?", (session.user_id, session.unique_id))
+
+    def load(self):
+        rows = self.db.execute("SELECT state, data, chat_id, message_id, updated_at FROM sessions").fetchall()
+        return [
+            {'state': state, 'data': json.loads(data), 'chat_id': chat_id, 'message_id': message_id, 'updated_at': updated_at}
+            for state, data, chat_id, message_id, updated_at in rows
+        ]
+
+journal = SessionJournal(JOURNAL_FILE) if JOURNAL_FILE else None
+
+# --- SESSION STORE ---
+# One Session per user. Idle sessions expire after SESSION_TTL seconds and
+# take their files in TEMP_DIR with them; files no live session owns
+# (e.g. left behind by a crash) are swept as well.
+SESSION_TTL = int(os.getenv("SESSION_TTL", 1800))
+SWEEP_INTERVAL = int(os.getenv("SWEEP_INTERVAL", 60))
+# Session fields besides the settings that travel with a queued job
+JOB_FIELDS = ('user_id', 'unique_id', 'file_url', 'original_name', 'input_path', 'input_file',
+              'duration', 'is_video', 'probe', 'probed', 'pcm')
+# ...and what the journal keeps on top of that to rebuild a session
+JOURNAL_FIELDS = ('file_id', 'file_unique_id', 'media_group_id', 'as_zip', 'remote_job', 'file_size')
+
+class Session:
+    __slots__ = (
+        'user_id', 'unique_id', 'file_id', 'file_unique_id', 'file_url', 'original_name',
+        'input_path', 'input_file', 'duration', 'is_video', 'probe', 'probed',
+        'format', 'bitrate', 'trim_start', 'trim_end', 'normalize', 'bass_boost',
+        'eight_d_audio', 'speed', 'waiting_for_trim', 'processing', 'previewing',
+        'job', 'download_lock', 'last_touched', 'created', 'media_group_id', 'batch',
+        'menu_message', 'as_zip', 'cancelled', 'pcm', 'remote_job', 'file_size',
+    )
+
+    def __init__(self, user_id, unique_id, file_id, file_unique_id, original_name, input_path, duration, is_video):
+        self.user_id = user_id
+        self.unique_id = unique_id
+        self.file_id = file_id
+        self.file_unique_id = file_unique_id
+        self.file_url = None
+        self.original_name = original_name
+        self.input_path = input_path
+        self.input_file = None
+        self.duration = duration
+        self.is_video = is_video
+        self.probe = None
+        self.probed = False
+        self.format = 'mp3'
+        self.bitrate = '192'
+        self.trim_start = 0
+        self.trim_end = None
+        self.normalize = False
+        self.bass_boost = False
+        self.eight_d_audio = False
+        self.speed = 1.0
+        self.waiting_for_trim = False
+        self.processing = False
+        self.previewing = False
+        self.job = None
+        self.download_lock = asyncio.Lock()
+        self.last_touched = time.monotonic()
+        self.created = self.last_touched
+        self.media_group_id = None
+        self.batch = []
+        self.menu_message = None
+        self.as_zip = False
+        self.cancelled = False
+        self.pcm = None
+        self.remote_job = None
+        self.file_size = 0
+
+    @property
+    def items(self):
+        """Every file this session's settings apply to, the first upload included."""
+        return [self] + self.batch
+
+    @property
+    def work_dir(self):
+        """TEMP_DIR, or RAM_DIR for a job placed there; all of the job's files go here."""
+        return os.path.dirname(self.input_path)
+
+    @property
+    def busy(self):
+        return self.processing or self.previewing or any(item.download_lock.locked() for item in self.items)
+
+    def owns(self, file_name):
+        # Keep in step with file_owner()
+        if file_name.startswith(f"{self.unique_id}_input") or f"_{self.unique_id}." in file_name:
+            return True
+        return any(item.owns(file_name) for item in self.batch)
+
+    def apply_settings(self, other):
+        for field in CACHE_KEY_FIELDS:
+            setattr(self, field, getattr(other, field))
+
+    def files(self):
+        return [
+            os.path.join(directory, name)
+            for directory in STORAGE_DIRS for name in os.listdir(directory) if self.owns(name)
+        ]
+
+    def to_job(self):
+        """What a worker process needs to render this session, as plain JSON types."""
+        return {field: getattr(self, field) for field in JOB_FIELDS + CACHE_KEY_FIELDS}
+
+    @classmethod
+    def from_job(cls, payload):
+        session = cls(payload['user_id'], payload['unique_id'], None, None, payload['original_name'],
+                      payload['input_path'], payload['duration'], payload['is_video'])
+        for field in JOB_FIELDS + CACHE_KEY_FIELDS:
+            setattr(session, field, payload[field])
+        return session
+
+    def to_journal(self):
+        data = self.to_job()
+        data.update({field: getattr(self, field) for field in JOURNAL_FIELDS})
+        data['batch'] = [item.to_journal() for item in self.batch]
+        return data
+
+    @classmethod
+    def from_journal(cls, data):
+        session = cls.from_job(data)
+        for field in JOURNAL_FIELDS:
+            setattr(session, field, data[field])
+        session.batch = [cls.from_journal(item) for item in data['batch']]
+        return session
+
+class SessionStore:
+    def __init__(self, ttl, journal=None):
+        self.ttl = ttl
+        self.journal = journal
+        # Set on SIGTERM: jobs cancelled by the shutdown skip their cancel
+        # handling, so they stay journaled as running and resume on restart
+        self.shutting_down = False
+        self._sessions = {}
+        # unique_id -> session whose job is running; it may since have been replaced by a new upload
+        self.active = {}
+        self.expired = 0
+
+    def __contains__(self, user_id):
+        return user_id in self._sessions
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __iter__(self):
+        return iter(list(self._sessions.values()))
+
+    def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session:
+            session.last_touched = time.monotonic()
+        return session
+
+    def put(self, session):
+        old = self._sessions.get(session.user_id)
+        if old and not old.busy:
+            cleanup_files(*old.files())
+        self._sessions[session.user_id] = session
+        self.save(session)
+
+    def owner(self, session):
+        """The stored session `session` belongs to (itself or its batch's lead), or None."""
+        lead = self._sessions.get(session.user_id)
+        return lead if lead and any(item is session for item in lead.items) else None
+
+    def save(self, session, message=None):
+        """Journals the stored session `session` belongs to (it may be a batch item)."""
+        lead = self.owner(session) if session else None
+        if not self.journal or not lead:
+            return
+        try:
+            self.journal.save(lead, message)
+        except sqlite3.Error as e:
+            logger.error(f"Journal Error: {e}")
+
+    def remove(self, session):
+        """Drops `session` unless it has already been replaced by a newer upload."""
+        if self._sessions.get(session.user_id) is session:
+            del self._sessions[session.user_id]
+            if self.journal:
+                self.journal.delete(session)
+
+    def expire_idle(self):
+        deadline = time.monotonic() - self.ttl
+        for user_id, session in list(self._sessions.items()):
+            if session.last_touched < deadline and not session.busy:
+                del self._sessions[user_id]
+                cleanup_files(*session.files())
+                if self.journal:
+                    self.journal.delete(session)
+                self.expired += 1
+
+    def sweep_orphans(self, max_age, directory=None):
+        """Deletes files older than `max_age` seconds that no session owns
+        from `directory`, or from every storage directory."""
+        cutoff = time.time() - max_age
+        removed = 0
+        paths = [os.path.join(d, name) for d in ([directory] if directory else STORAGE_DIRS) for name in os.listdir(d)]
+        for path in paths:
+            name = os.path.basename(path)
+            try:
+                if os.path.getmtime(path) > cutoff or any(s.owns(name) for s in self._sessions.values()):
+                    continue
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+        return removed
+
+    async def run_sweeper(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                self.expire_idle()
+                self.sweep_orphans(self.ttl)
+            except Exception as e:
+                logger.error(f"Session Sweep Error: {e}")
+
+user_sessions = SessionStore(SESSION_TTL, journal)
+
+def cancel_markup(session):
+    # Names the job, so Cancel still reaches it after a newer upload replaced the session
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_job:{session.unique_id}")]])
+
+# --- STORAGE ---
+# Disk admission control. Every download and render holds a reservation
+# sized from the upload's file_size and the output's bitrate × duration
+# until its job ends. Usage is each reservation (or what its files
+# actually take, if more) plus every other file, measured per directory
+# against a quota. When a new reservation doesn't fit, idle sessions'
+# artefacts are evicted, least recently used first: orphans, then PCM
+# caches, then downloaded inputs (Telegram still has those). If that
+# isn't enough the download waits up to STORAGE_WAIT seconds for other
+# jobs to finish, then gives up. Small jobs can live on a RAM disk
+# (RAM_DIR) instead.
+STORAGE_QUOTA_MB = int(os.getenv("STORAGE_QUOTA_MB", 0))  # 0: 80% of the space TEMP_DIR can use
+STORAGE_WAIT = float(os.getenv("STORAGE_WAIT", 60))
+RAM_QUOTA_MB = int(os.getenv("RAM_QUOTA_MB", 256))
+RAM_JOB_MAX_MB = int(os.getenv("RAM_JOB_MAX_MB", 32))
+PCM_BYTES_PER_SECOND = 48000 * 2 * 2
+MB = 1024 * 1024
+
+class StorageFullError(Exception):
+    def __str__(self):
+        return "Not enough temporary storage right now."
+
+def estimate_bytes(session):
+    """Disk a job may need: the download plus the output (and the FLAC
+    chunks of a segmented render), before any of it exists."""
+    downloads = not LOCAL_BOT_API and session.input_file in (None, session.input_path)
+    seconds = expected_duration(session)
+    if not seconds:
+        # Documents have no duration until probed; guess from the size
+        seconds = session.file_size / (125000 if session.is_video else 16000)
+    if session.format in LOSSLESS_FORMATS:
+        output = seconds * PCM_BYTES_PER_SECOND
+    else:
+        output = seconds * int(session.bitrate) * 125
+    if seconds >= SEGMENT_MIN_DURATION:
+        output += seconds * PCM_BYTES_PER_SECOND * 2
+    if session.is_video:
+        output += 512 * 1024  # thumbnail
+    return int((session.file_size if downloads else 0) + output)
+
+def file_owner(file_name):
+    """unique_id of the session (or batch item) a temp file is named after, or None."""
+    if "_input" in file_name:
+        return file_name.split("_input", 1)[0]
+    stem, dot, _ = file_name.rpartition('.')
+    _, sep, unique_id = stem.partition('_')
+    return unique_id if dot and sep else None
+
+class StorageManager:
+    def __init__(self, quotas):
+        self.quotas = quotas  # directory -> bytes
+        # unique_id (a job) or pcm_<unique_id> (a PCM cache decode) -> (session, directory, bytes)
+        self.reservations = {}
+        self.evicted = 0
+        self.refused = 0
+        self._freed = None
+
+    def _scan(self, directory):
+        """Bytes per reservation in `directory`, per idle-session or orphan file, and the rest."""
+        active = sorted(((key, s) for key, (s, d, _) in self.reservations.items() if d == directory),
+                        key=lambda held: len(held[1].unique_id), reverse=True)  # batch items before their lead
+        owned = {key: 0 for key, _ in active}
+        other = 0
+        for entry in os.scandir(directory):
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                continue
+            is_pcm = entry.name.startswith(('pcm_', 'pcmthumb_'))
+            owner = next((key for key, s in active if s.owns(entry.name) and key.startswith('pcm_') == is_pcm), None)
+            if owner:
+                owned[owner] += size
+            else:
+                other += size
+        return owned, other
+
+    def usage(self, directory=TEMP_DIR):
+        owned, other = self._scan(directory)
+        reserved = sum(max(need, owned[key]) for key, (_, d, need) in self.reservations.items() if d == directory)
+        return reserved + other
+
+    def headroom(self, directory=TEMP_DIR):
+        return self.quotas[directory] - self.usage(directory)
+
+    def _idle_sessions(self):
+        """Stored sessions with nothing running or reserved, least recently used first."""
+        reserved = {s.unique_id for s, _, _ in self.reservations.values()}
+        return [
+            session for session in sorted(user_sessions, key=lambda s: s.last_touched)
+            if not session.busy and not any(item.unique_id in reserved for item in session.items)
+        ]
+
+    def evictable(self, directory=TEMP_DIR):
+        idle = {session.unique_id for session in self._idle_sessions()}
+        held = {item.unique_id for session in user_sessions if session.unique_id not in idle for item in session.items}
+        total = 0
+        for entry in os.scandir(directory):
+            if file_owner(entry.name) in held:
+                continue
+            try:
+                total += entry.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def _evict(self, directory, need):
+        """Frees idle artefacts until `need` bytes fit. Returns True if they do."""
+        if need > self.quotas[directory]:
+            return False
+        if user_sessions.sweep_orphans(60, directory) and need <= self.headroom(directory):
+            return True
+        idle = self._idle_sessions()
+        for free in (self._drop_pcm, self._drop_input):
+            for session in idle:
+                if free(session, directory):
+                    self.evicted += 1
+                    if need <= self.headroom(directory):
+                        return True
+        return False
+
+    def _drop_pcm(self, session, directory):
+        dropped = False
+        for item in session.items:
+            if item.pcm and os.path.dirname(item.pcm['path']) == directory:
+                pcm_cache.drop(item)
+                dropped = True
+        return dropped
+
+    def _drop_input(self, session, directory):
+        dropped = False
+        for item in session.items:
+            if item.input_file and item.input_file == item.input_path and item.work_dir == directory:
+                cleanup_files(item.input_file)
+                item.input_file = None
+                dropped = True
+        if dropped:
+            user_sessions.save(session)
+        return dropped
+
+    def admissible(self, session):
+        """Upload-time check: could this job ever get its reservation right now?"""
+        need = estimate_bytes(session)
+        directory = session.work_dir
+        return need <= self.headroom(directory) + self.evictable(directory)
+
+    def place(self, session):
+        """Puts a small job's files on the RAM disk, if there is one with room."""
+        need = estimate_bytes(session)
+        if RAM_DIR and need <= RAM_JOB_MAX_MB * MB and need <= self.headroom(RAM_DIR):
+            session.input_path = os.path.join(RAM_DIR, os.path.basename(session.input_path))
+
+    async def reserve(self, session, timeout=STORAGE_WAIT):
+        """Holds room for the session's job, evicting or waiting as needed. Raises StorageFullError."""
+        if self._freed is None:
+            self._freed = asyncio.Condition()
+        if session.work_dir != TEMP_DIR and not session.input_file and estimate_bytes(session) > RAM_JOB_MAX_MB * MB:
+            # Settings grew the job past the RAM disk before anything landed there
+            session.input_path = os.path.join(TEMP_DIR, os.path.basename(session.input_path))
+        need = estimate_bytes(session)
+        directory = session.work_dir
+        previous = self.reservations.pop(session.unique_id, None)
+        deadline = time.monotonic() + timeout
+        async with self._freed:
+            while True:
+                if need <= self.headroom(directory) or self._evict(directory, need):
+                    self.reservations[session.unique_id] = (session, directory, need)
+                    return
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or need > self.quotas[directory]:
+                    if previous:
+                        self.reservations[session.unique_id] = previous
+                    self.refused += 1
+                    raise StorageFullError()
+                try:
+                    await asyncio.wait_for(self._freed.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    def release(self, *sessions):
+        released = [s for s in sessions if self.reservations.pop(s.unique_id, None)]
+        if released and self._freed:
+            asyncio.create_task(self._wake())
+
+    def reserve_pcm(self, session, size):
+        """Holds TEMP_DIR room for decoding the session's PCM cache. Evicts
+        idle files but never waits; returns False if it doesn't fit."""
+        if size > self.quotas[TEMP_DIR]:
+            return False
+        key = f"pcm_{session.unique_id}"
+        # Held before evicting, so the session's own input is spared
+        self.reservations[key] = (session, TEMP_DIR, size)
+        if self.headroom(TEMP_DIR) >= 0 or self._evict(TEMP_DIR, 0):
+            return True
+        del self.reservations[key]
+        return False
+
+    def release_pcm(self, session):
+        # Once written, the WAV counts as a plain file in TEMP_DIR
+        if self.reservations.pop(f"pcm_{session.unique_id}", None) and self._freed:
+            asyncio.create_task(self._wake())
+
+    async def _wake(self):
+        async with self._freed:
+            self._freed.notify_all()
+
+    def stats(self):
+        areas = {}
+        for directory, quota in self.quotas.items():
+            used = self.usage(directory)
+            areas[directory] = {'quota': quota, 'used': used, 'headroom': quota - used}
+        return {
+            **areas,
+            'reservations': len(self.reservations),
+            'reserved_bytes': sum(need for _, _, need in self.reservations.values()),
+            'evicted': self.evicted,
+            'refused': self.refused,
+        }
+
+def default_quota(directory):
+    disk = shutil.disk_usage(directory)
+    return int((disk.free + temp_dir_usage()) * 0.8)
+
+storage_quotas = {TEMP_DIR: STORAGE_QUOTA_MB * MB or default_quota(TEMP_DIR)}
+if RAM_DIR:
+    storage_quotas[RAM_DIR] = RAM_QUOTA_MB * MB
+storage = StorageManager(storage_quotas)
+Gauge('bot_storage_used_bytes', 'Reserved or used bytes in TEMP_DIR').set_function(lambda: storage.usage())
+Gauge('bot_storage_headroom_bytes', 'Bytes left under the TEMP_DIR quota').set_function(lambda: storage.headroom())
+
+# --- JOB SCHEDULER ---
+# A fixed number of ffmpeg slots (one per core by default) and a bounded
+# waiting list. Jobs beyond MAX_QUEUE are rejected instead of piling up.
+# A free slot goes to the waiting job with the lowest estimated cost (see
+# COST MODEL), less JOB_AGING seconds for every second it has waited, so
+# short jobs go first and long ones still get their turn. Each slot a user
+# already holds raises the cost of their next job, and a user at
+# USER_SLOTS only gets another slot when nobody else is waiting.
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", os.cpu_count() or 1))
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", 20))
+USER_SLOTS = int(os.getenv("USER_SLOTS", max(1, MAX_WORKERS // 2)))
+JOB_AGING = float(os.getenv("JOB_AGING", 1.0))
+# With JOB_QUEUE set, ffmpeg runs in worker processes and a slot here only
+# waits on one, so allow many more of them
+JOB_QUEUE = os.getenv("JOB_QUEUE")
+REMOTE_INFLIGHT = int(os.getenv("REMOTE_INFLIGHT", 100))
+
+class QueueFullError(Exception):
+    def __str__(self):
+        return "Too many files in queue."
+
+class Job:
+    def __init__(self, user_id, func, on_position=None, cost=0.0):
+        self.user_id = user_id
+        self.func = func
+        self.on_position = on_position
+        self.cost = cost
+        self.position = None
+        self.future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.task = None
+
+class TranscodeScheduler:
+    def __init__(self, name, workers, max_pending, user_slots=USER_SLOTS):
+        self.name = name
+        self.workers = max(1, workers)
+        self.max_pending = max_pending
+        self.user_slots = max(1, user_slots)
+        self.pending = []
+        self.running = {}  # user_id -> slots held
+        self.active = 0
+        self.borrowed = 0  # idle slots lent to running jobs' extra processes
+        self.completed = 0
+        self.rejected = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._cond = None
+        self._tasks = []
+
+    async def start(self):
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"{self.name} scheduler started: {self.workers} workers, queue limit {self.max_pending}")
+
+    async def submit(self, user_id, func, on_position=None, cost=0.0):
+        """Queues `func` (a coroutine function) and returns its Job. Raises QueueFullError.
+
+        `on_position` is awaited with the 1-based queue position whenever it
+        changes, and with 0 once a worker picks the job up. `cost` is the
+        job's estimated run time in seconds.
+        """
+        if len(self.pending) >= self.max_pending:
+            self.rejected += 1
+            raise QueueFullError()
+        job = Job(user_id, func, on_position, cost)
+        async with self._cond:
+            self.pending.append(job)
+            self._cond.notify()
+        self._publish_positions()
+        return job
+
+    def _score(self, job, now):
+        held = self.running.get(job.user_id, 0)
+        return job.cost * (1 + held) - JOB_AGING * (now - job.enqueued_at)
+
+    def _pick(self):
+        """The pending job a free slot should run next, or None."""
+        if not self.pending:
+            return None
+        eligible = [job for job in self.pending if self.running.get(job.user_id, 0) < self.user_slots]
+        now = time.monotonic()
+        # Users at their cap may use slots nobody else is waiting for
+        return min(eligible or self.pending, key=lambda job: (self._score(job, now), job.enqueued_at))
+
+    def _publish_positions(self):
+        now = time.monotonic()
+        ordered = sorted(self.pending, key=lambda job: (self._score(job, now), job.enqueued_at))
+        for index, job in enumerate(ordered, start=1):
+            if job.position != index and job.on_position:
+                job.position = index
+                asyncio.create_task(self._notify(job, index))
+
+    async def _notify(self, job, position):
+        try:
+            await job.on_position(position)
+        except Exception as e:
+            logger.debug(f"Queue position update failed: {e}")
+
+    def cancel(self, job):
+        """Drops a queued job or cancels a running one, freeing its slot at once."""
+        if job in self.pending:
+            self.pending.remove(job)
+            job.future.cancel()
+            self._publish_positions()
+            return True
+        if job.task and not job.task.done():
+            job.task.cancel()
+            return True
+        return False
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                while self.active + self.borrowed >= self.workers or (job := self._pick()) is None:
+                    await self._cond.wait()
+                self.pending.remove(job)
+                self.running[job.user_id] = self.running.get(job.user_id, 0) + 1
+                self.active += 1
+            job.started_at = time.monotonic()
+            wait = job.started_at - job.enqueued_at
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            if job.on_position:
+                asyncio.create_task(self._notify(job, 0))
+            self._publish_positions()
+            job.task = asyncio.create_task(job.func())
+            try:
+                job.future.set_result(await job.task)
+            except asyncio.CancelledError:
+                if not job.task.cancelled():
+                    raise
+                job.future.cancel()
+            except Exception as e:
+                job.future.set_exception(e)
+            finally:
+                self.active -= 1
+                self.completed += 1
+                self.running[job.user_id] -= 1
+                if not self.running[job.user_id]:
+                    del self.running[job.user_id]
+                async with self._cond:
+                    self._cond.notify_all()
+
+    def borrow(self, wanted):
+        """Lends up to `wanted` idle slots to a running job and returns how
+        many it got. They stay taken until give_back()."""
+        lent = max(0, min(wanted, self.workers - self.active - self.borrowed))
+        self.borrowed += lent
+        return lent
 
-user_sessions = {}
+    def give_back(self, count):
+        self.borrowed -= count
+        if count and self._cond:
+            asyncio.create_task(self._wake())
+
+    async def _wake(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def stats(self):
+        started = self.completed + self.active
+        return {
+            'workers': self.workers,
+            'active': self.active,
+            'borrowed': self.borrowed,
+            'queued': len(self.pending),
+            'queue_limit': self.max_pending,
+            'user_slots': self.user_slots,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'avg_wait': round(self.total_wait / started, 2) if started else 0.0,
+            'max_wait': round(self.max_wait, 2),
+        }
+
+scheduler = TranscodeScheduler("Transcode", REMOTE_INFLIGHT if JOB_QUEUE else MAX_WORKERS, MAX_QUEUE)
+
+# --- JOB QUEUE ---
+# Optional split between the bot and transcode workers. With JOB_QUEUE set
+# (sqlite:///jobs.db or redis://host:6379/0) each render is written to the
+# queue and picked up by `python bot.py worker` processes, on this host or
+# others sharing TEMP_DIR. A worker keeps its claim alive with heartbeats;
+# if it dies, the job becomes visible again after JOB_VISIBILITY_TIMEOUT
+# and another worker retries it, up to JOB_MAX_ATTEMPTS times.
+# Workers claim jobs in the scheduler's order (see JOB SCHEDULER): lowest
+# estimated cost, aged by JOB_AGING, with USER_SLOTS running jobs per user
+# across all workers before that user has to wait for an idle queue. Cost
+# plus JOB_AGING × enqueue time is a fixed priority per job, so queue
+# order only changes with the per-user load.
+JOB_VISIBILITY_TIMEOUT = int(os.getenv("JOB_VISIBILITY_TIMEOUT", 120))
+JOB_HEARTBEAT = float(os.getenv("JOB_HEARTBEAT", 5))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", 1))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETENTION = 3600
+JOB_CLAIM_WINDOW = 50  # best-priority Redis jobs a claim weighs per-user load for
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", MAX_WORKERS))
+
+class SQLiteJobQueue:
+    """Jobs table in a SQLite file. Every call opens its own connection, so
+    the methods are safe to run through asyncio.to_thread."""
+
+    def __init__(self, path):
+        self.path = path
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, payload TEXT NOT NULL, status TEXT NOT NULL,"
+                " enqueued_at REAL NOT NULL, visible_at REAL NOT NULL DEFAULT 0, finished_at REAL,"
+                " attempts INTEGER NOT NULL DEFAULT 0, worker TEXT, cancel_requested INTEGER NOT NULL DEFAULT 0,"
+                " progress INTEGER, eta INTEGER, result TEXT, error TEXT, user_id INTEGER, cost REAL NOT NULL DEFAULT 0)"
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+            for column, definition in (('user_id', "INTEGER"), ('cost', "REAL NOT NULL DEFAULT 0")):
+                if column not in columns:  # queue files from before cost-ordered claims
+                    db.execute(f"ALTER TABLE jobs ADD COLUMN {column} {definition}")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, enqueued_at)")
+
+    @contextlib.contextmanager
+    def _db(self):
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def enqueue(self, job_id, payload, user_id=None, cost=0.0):
+        with self._db() as db:
+            db.execute("INSERT INTO jobs (id, payload, status, enqueued_at, user_id, cost) VALUES (?, ?, 'queued', ?, ?, ?)",
+                       (job_id, json.dumps(payload), time.time(), user_id, cost))
+
+    def claim(self, worker, timeout):
+        """Takes the best visible job for `worker`. Returns (job_id, payload) or None."""
+        now = time.time()
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                # Settle jobs whose worker stopped heartbeating and can't be retried
+                db.execute("UPDATE jobs SET status = 'cancelled', finished_at = ? WHERE status = 'running'"
+                           " AND visible_at < ? AND cancel_requested = 1", (now, now))
+                db.execute("UPDATE jobs SET status = 'failed', finished_at = ?, error = 'Worker lost' WHERE"
+                           " status = 'running' AND visible_at < ? AND attempts >= ?", (now, now, JOB_MAX_ATTEMPTS))
+                # Users under their cap first, then by aged cost weighted by the user's running jobs
+                row = db.execute(
+                    "SELECT j.id, j.payload FROM jobs j LEFT JOIN (SELECT user_id, COUNT(*) AS held FROM jobs"
+                    " WHERE status = 'running' AND visible_at >= ? GROUP BY user_id) r ON r.user_id = j.user_id"
+                    " WHERE j.status = 'queued' OR (j.status = 'running' AND j.visible_at < ?)"
+                    " ORDER BY COALESCE(r.held, 0) >= ?, j.cost * (1 + COALESCE(r.held, 0)) + ? * j.enqueued_at,"
+                    " j.enqueued_at LIMIT 1", (now, now, USER_SLOTS, JOB_AGING)
+                ).fetchone()
+                if row:
+                    db.execute("UPDATE jobs SET status = 'running', worker = ?, visible_at = ?, attempts = attempts + 1,"
+                               " progress = NULL, eta = NULL WHERE id = ?", (worker, now + timeout, row[0]))
+                db.execute("COMMIT")
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+        return (row[0], json.loads(row[1])) if row else None
+
+    def heartbeat(self, job_id, worker, timeout, percent=None, eta=None):
+        """Extends the claim and stores progress. True means the worker should stop:
+        the job was cancelled, or the claim expired and someone else owns it."""
+        with self._db() as db:
+            updated = db.execute(
+                "UPDATE jobs SET visible_at = ?, progress = ?, eta = ? WHERE id = ? AND worker = ? AND status = 'running'",
+                (time.time() + timeout, percent, eta, job_id, worker)
+            ).rowcount
+            if not updated:
+                return True
+            return bool(db.execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+    def finish(self, job_id, worker, status, result=None, error=None):
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?"
+                " WHERE id = ? AND worker = ? AND status = 'running'",
+                (status, json.dumps(result) if result else None, error, time.time(), job_id, worker)
+            )
+
+    def get(self, job_id):
+        with self._db() as db:
+            row = db.execute(
+                "SELECT status, progress, eta, result, error, cost + ? * enqueued_at FROM jobs WHERE id = ?",
+                (JOB_AGING, job_id)
+            ).fetchone()
+            if not row:
+                return None
+            position = None
+            if row[0] == 'queued':
+                position = db.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND cost + ? * enqueued_at <= ?",
+                                      (JOB_AGING, row[5])).fetchone()[0]
+        return {
+            'status': row[0], 'progress': row[1], 'eta': row[2],
+            'result': json.loads(row[3]) if row[3] else None, 'error': row[4], 'position': position,
+        }
+
+    def cancel(self, job_id):
+        with self._db() as db:
+            db.execute(
+                "UPDATE jobs SET cancel_requested = 1, status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END,"
+                " finished_at = CASE WHEN status = 'queued' THEN ? ELSE finished_at END WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def delete(self, job_id):
+        with self._db() as db:
+            db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def purge(self, max_age):
+        with self._db() as db:
+            db.execute("DELETE FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished_at < ?",
+                       (time.time() - max_age,))
+
+    def stats(self):
+        with self._db() as db:
+            return dict(db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+
+class RedisJobQueue:
+    """Same contract on Redis: a hash per job, a sorted set of queued ids by
+    priority, one of running ids by visibility deadline and a hash of
+    running jobs per user."""
+
+    # Moves the best of the first ARGV[2] queued ids to the running set in one
+    # step: users under ARGV[3] running jobs first, then by priority plus cost
+    # for every job the user already runs
+    CLAIM_SCRIPT = """
+    local ids = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[2]) - 1, 'WITHSCORES')
+    local best, best_score, best_capped, best_user
+    for i = 1, #ids, 2 do
+        local job = redis.call('HMGET', ARGV[4] .. ':' .. ids[i], 'user_id', 'cost')
+        local user = job[1] or ''
+        local held = tonumber(redis.call('HGET', KEYS[3], user) or 0)
+        local capped = held >= tonumber(ARGV[3])
+        local score = tonumber(ids[i + 1]) + (tonumber(job[2]) or 0) * held
+        if not best or (best_capped and not capped) or (capped == best_capped and score < best_score) then
+            best, best_score, best_capped, best_user = ids[i], score, capped, user
+        end
+    end
+    if not best then return false end
+    redis.call('ZREM', KEYS[1], best)
+    redis.call('ZADD', KEYS[2], ARGV[1], best)
+    redis.call('HINCRBY', KEYS[3], best_user, 1)
+    return best
+    """
+
+    def __init__(self, url, prefix="bot:jobs"):
+        import redis  # only needed for redis:// queues
+        self.redis = redis.Redis.from_url(url, decode_responses=True)
+        self.queued = f"{prefix}:queued"
+        self.running = f"{prefix}:running"
+        self.held = f"{prefix}:held"
+        self.prefix = prefix
+        self._claim = self.redis.register_script(self.CLAIM_SCRIPT)
+
+    def _key(self, job_id):
+        return f"{self.prefix}:{job_id}"
+
+    def enqueue(self, job_id, payload, user_id=None, cost=0.0):
+        now = time.time()
+        priority = cost + JOB_AGING * now
+        pipe = self.redis.pipeline()
+        pipe.hset(self._key(job_id), mapping={
+            'payload': json.dumps(payload), 'status': 'queued', 'enqueued_at': now, 'attempts': 0, 'cancel': 0,
+            'user_id': '' if user_id is None else user_id, 'cost': cost, 'priority': priority,
+        })
+        pipe.zadd(self.queued, {job_id: priority})
+        pipe.execute()
+
+    def _stop_running(self, job_id, job=None):
+        """Takes the id off the running set. False if it wasn't there."""
+        if not self.redis.zrem(self.running, job_id):
+            return False
+        user = (job or {}).get('user_id')
+        if user is None:
+            user = self.redis.hget(self._key(job_id), 'user_id')
+        self.redis.hincrby(self.held, user or '', -1)
+        return True
+
+    def _requeue_expired(self, now):
+        for job_id in self.redis.zrangebyscore(self.running, '-inf', now):
+            key = self._key(job_id)
+            job = self.redis.hgetall(key)
+            if not self._stop_running(job_id, job):
+                continue  # another worker got to it first
+            if not job:
+                continue
+            if job.get('cancel') == '1':
+                self.redis.hset(key, mapping={'status': 'cancelled', 'finished_at': now})
+                self.redis.expire(key, JOB_RETENTION)
+            elif int(job.get('attempts', 0)) >= JOB_MAX_ATTEMPTS:
+                self.redis.hset(key, mapping={'status': 'failed', 'error': 'Worker lost', 'finished_at': now})
+                self.redis.expire(key, JOB_RETENTION)
+            else:
+                self.redis.hset(key, 'status', 'queued')
+                self.redis.zadd(self.queued, {job_id: float(job.get('priority') or job['enqueued_at'])})
+
+    def claim(self, worker, timeout):
+        now = time.time()
+        self._requeue_expired(now)
+        while True:
+            job_id = self._claim(keys=[self.queued, self.running, self.held],
+                                 args=[now + timeout, JOB_CLAIM_WINDOW, USER_SLOTS, self.prefix])
+            if not job_id:
+                return None
+            key = self._key(job_id)
+            job = self.redis.hgetall(key)
+            if not job or job.get('cancel') == '1':
+                self._stop_running(job_id, job)
+                continue
+            pipe = self.redis.pipeline()
+            pipe.hset(key, mapping={'status': 'running', 'worker': worker, 'progress': '', 'eta': ''})
+            pipe.hincrby(key, 'attempts', 1)
+            pipe.execute()
+            return job_id, json.loads(job['payload'])
+
+    def heartbeat(self, job_id, worker, timeout, percent=None, eta=None):
+        key = self._key(job_id)
+        job = self.redis.hgetall(key)
+        if job.get('worker') != worker or job.get('status') != 'running':
+            return True
+        pipe = self.redis.pipeline()
+        pipe.zadd(self.running, {job_id: time.time() + timeout}, xx=True)
+        pipe.hset(key, mapping={'progress': '' if percent is None else percent, 'eta': '' if eta is None else eta})
+        pipe.execute()
+        return job.get('cancel') == '1'
+
+    def finish(self, job_id, worker, status, result=None, error=None):
+        key = self._key(job_id)
+        if self.redis.hget(key, 'worker') != worker:
+            return
+        self._stop_running(job_id)
+        pipe = self.redis.pipeline()
+        pipe.hset(key, mapping={
+            'status': status, 'result': json.dumps(result) if result else '', 'error': error or '',
+            'finished_at': time.time(),
+        })
+        pipe.expire(key, JOB_RETENTION)
+        pipe.execute()
+
+    def get(self, job_id):
+        job = self.redis.hgetall(self._key(job_id))
+        if not job:
+            return None
+        position = None
+        if job['status'] == 'queued':
+            rank = self.redis.zrank(self.queued, job_id)
+            position = None if rank is None else rank + 1
+        return {
+            'status': job['status'],
+            'progress': int(job['progress']) if job.get('progress') else None,
+            'eta': int(job['eta']) if job.get('eta') else None,
+            'result': json.loads(job['result']) if job.get('result') else None,
+            'error': job.get('error') or None,
+            'position': position,
+        }
+
+    def cancel(self, job_id):
+        key = self._key(job_id)
+        self.redis.hset(key, 'cancel', 1)
+        if self.redis.zrem(self.queued, job_id):
+            self.redis.hset(key, mapping={'status': 'cancelled', 'finished_at': time.time()})
+            self.redis.expire(key, JOB_RETENTION)
+
+    def delete(self, job_id):
+        self._stop_running(job_id)
+        pipe = self.redis.pipeline()
+        pipe.delete(self._key(job_id))
+        pipe.zrem(self.queued, job_id)
+        pipe.execute()
+
+    def purge(self, max_age):
+        pass  # finished jobs expire on their own
+
+    def stats(self):
+        return {'queued': self.redis.zcard(self.queued), 'running': self.redis.zcard(self.running)}
+
+def open_job_queue(url):
+    if not url:
+        return None
+    if url.startswith(("redis://", "rediss://")):
+        return RedisJobQueue(url)
+    if url.startswith("sqlite:///"):
+        return SQLiteJobQueue(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported JOB_QUEUE: {url}")
+
+job_queue = open_job_queue(JOB_QUEUE)
+
+def render_job(session, on_progress=None, on_position=None):
+    """The coroutine a scheduler slot runs: the render itself, or a wait on a worker."""
+    if job_queue:
+        return remote_render(session, on_progress, on_position)
+    return run_ffmpeg_command(session, on_progress)
+
+async def remote_render(session, on_progress=None, on_position=None):
+    """Queues the render for a worker process and relays its queue position
+    and progress. Returns what run_ffmpeg_command would."""
+    job_id = session.remote_job
+    # After a restart the journaled job may still be queued, running or done
+    if not job_id or await asyncio.to_thread(job_queue.get, job_id) is None:
+        job_id = f"{session.unique_id}_{time.time_ns()}"
+        await asyncio.to_thread(job_queue.enqueue, job_id, session.to_job(), session.user_id, cost_model.estimate(session))
+        session.remote_job = job_id
+        user_sessions.save(session)
+    reported = None
+    try:
+        while True:
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            state = await asyncio.to_thread(job_queue.get, job_id)
+            if state is None:
+                raise RuntimeError("Job disappeared from the queue")
+            if state['status'] == 'done':
+                await asyncio.to_thread(job_queue.delete, job_id)
+                result = state['result']
+                return result['output_path'], result['thumb_path'], result['caption']
+            if state['status'] == 'failed':
+                await asyncio.to_thread(job_queue.delete, job_id)
+                raise RuntimeError(state['error'] or "Worker failed")
+            if state['status'] == 'cancelled':
+                raise asyncio.CancelledError()
+
+            update = (state['status'], state['position'], state['progress'], state['eta'])
+            if update == reported:
+                continue
+            reported = update
+            try:
+                if state['status'] == 'queued' and on_position and state['position']:
+                    await on_position(state['position'])
+                elif state['status'] == 'running' and on_progress:
+                    await on_progress(state['progress'], state['eta'])
+            except Exception as e:
+                logger.debug(f"Remote job update failed: {e}")
+    except asyncio.CancelledError:
+        # The worker sees the flag on its next heartbeat and kills ffmpeg.
+        # A bot shutting down leaves it running for the restarted bot.
+        if not user_sessions.shutting_down:
+            await asyncio.to_thread(job_queue.cancel, job_id)
+        raise
+    finally:
+        if not user_sessions.shutting_down:
+            session.remote_job = None
+
+# --- RESULT CACHE ---
+# Maps (source file_unique_id + conversion settings) to the Telegram file_id
+# of an output we already uploaded, so repeat requests skip download,
+# ffmpeg and upload entirely. Least recently used entries are dropped first.
+RESULT_CACHE_FILE = os.getenv("RESULT_CACHE_FILE", "result_cache.json")
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 1000))
+RESULT_CACHE_SAVE_INTERVAL = 60  # hits only reorder entries, so they're saved lazily
+
+CACHE_KEY_FIELDS = ('format', 'bitrate', 'trim_start', 'trim_end', 'speed', 'bass_boost', 'eight_d_audio', 'normalize')
+
+class ResultCache:
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._dirty = False
+        self._saved_at = 0.0
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                self.entries = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Result cache load failed: {e}")
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        self._dirty = False
+        self._saved_at = time.monotonic()
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(list(self.entries.items()), f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Result cache save failed: {e}")
+
+    def flush(self):
+        """Saves recency changes from hits that haven't been written yet."""
+        if self._dirty:
+            self._save()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        self._dirty = True
+        if time.monotonic() - self._saved_at >= RESULT_CACHE_SAVE_INTERVAL:
+            self._save()
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        self._save()
+
+    def discard(self, key):
+        if self.entries.pop(key, None) is not None:
+            self._save()
+
+def result_cache_key(session):
+    settings = {field: getattr(session, field) for field in CACHE_KEY_FIELDS}
+    raw = json.dumps([session.file_unique_id, settings], sort_keys=True)
+    return hashlib.sha1(raw.encode()).hexdigest()
+
+result_cache = ResultCache(RESULT_CACHE_FILE, RESULT_CACHE_SIZE)
+
+# --- COST MODEL ---
+# Estimates how long a render will take, for the scheduler's shortest-job-
+# first ordering: media seconds × encode seconds per media second for the
+# output codec, effects and input kind. The per-second rates start from
+# rough defaults and follow a moving average of measured single-pass
+# encodes, kept in COST_MODEL_FILE across restarts (empty: not persisted).
+# Stream copies, streamed (download-bound), segmented and PCM cache renders
+# aren't measured: their wall time says little about encoding cost.
+COST_MODEL_FILE = os.getenv("COST_MODEL_FILE", "cost_model.json")
+COST_OVERHEAD = 0.5  # process start-up, probe, thumbnail
+COST_ALPHA = 0.2
+COST_MIN_SECONDS = 10  # shorter renders are mostly overhead
+CODEC_RATES = {'mp3': 0.02, 'm4a': 0.02, 'aac': 0.02, 'ogg': 0.03, 'flac': 0.01, 'wav': 0.005}
+EFFECT_RATES = {'speed': 0.01, 'bass': 0.003, '8d': 0.005, 'normalize': 0.02}
+VIDEO_RATE = 0.01  # demuxing the audio out of a video container
+
+def cost_key(session):
+    return f"{session.format}|{effects_label(session)}|{'video' if session.is_video else 'audio'}"
+
+def default_rate(session):
+    rate = CODEC_RATES.get(session.format, 0.02)
+    rate += sum(EFFECT_RATES.get(name, 0) for name in effects_label(session).split('+'))
+    if session.is_video:
+        rate += VIDEO_RATE
+    return rate
+
+class CostModel:
+    def __init__(self, path):
+        self.path = path
+        self.rates = {}
+        self.samples = 0
+        self._load()
+
+    def _load(self):
+        if not self.path:
+            return
+        try:
+            with open(self.path) as f:
+                self.rates = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.error(f"Cost model load failed: {e}")
+
+    def _save(self):
+        if not self.path:
+            return
+        # Per-process tmp name: job queue workers share the file
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(self.rates, f)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            logger.error(f"Cost model save failed: {e}")
+
+    def rate(self, session):
+        return self.rates.get(cost_key(session)) or default_rate(session)
+
+    def estimate(self, session):
+        """Expected render time of the session in seconds."""
+        seconds = expected_duration(session)
+        if not seconds:
+            # Documents have no duration until probed; guess from the size
+            seconds = session.file_size / (125000 if session.is_video else 16000)
+        return COST_OVERHEAD + seconds * self.rate(session)
+
+    def record(self, session, elapsed):
+        seconds = expected_duration(session)
+        if seconds < COST_MIN_SECONDS:
+            return
+        key = cost_key(session)
+        # Process start-up stays in: it's a small share of a 10s+ encode, and
+        # subtracting a flat guess could drive fast encodes to zero
+        measured = elapsed / seconds
+        previous = self.rates.get(key)
+        self.rates[key] = measured if previous is None else previous + COST_ALPHA * (measured - previous)
+        self.samples += 1
+        self._save()
+
+    def stats(self):
+        return {'keys': len(self.rates), 'samples': self.samples}
+
+cost_model = CostModel(COST_MODEL_FILE)
 
 # --- HELPER FUNCTIONS ---
 
+# --- SUBSCRIPTION CACHE ---
+# Membership answers are remembered per user (positive ones for longer) and
+# concurrent checks for the same user share one get_chat_member call.
+SUB_CACHE_TTL = int(os.getenv("SUB_CACHE_TTL", 600))
+SUB_CACHE_NEGATIVE_TTL = int(os.getenv("SUB_CACHE_NEGATIVE_TTL", 30))
+SUB_CACHE_MAX_ENTRIES = 10000
+
+class SubscriptionCache:
+    def __init__(self, ttl, negative_ttl):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.entries = {}
+        self.inflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def check(self, user_id, fetch):
+        now = time.monotonic()
+        entry = self.entries.get(user_id)
+        if entry and entry[1] > now:
+            self.hits += 1
+            return entry[0]
+
+        task = self.inflight.get(user_id)
+        if task:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        self.misses += 1
+        task = asyncio.ensure_future(fetch())
+        self.inflight[user_id] = task
+        try:
+            is_member = await asyncio.shield(task)
+        finally:
+            self.inflight.pop(user_id, None)
+
+        if len(self.entries) >= SUB_CACHE_MAX_ENTRIES:
+            self.entries = {uid: e for uid, e in self.entries.items() if e[1] > now}
+        self.entries[user_id] = (is_member, now + (self.ttl if is_member else self.negative_ttl))
+        return is_member
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced, 'entries': len(self.entries)}
+
+subscription_cache = SubscriptionCache(SUB_CACHE_TTL, SUB_CACHE_NEGATIVE_TTL)
+
 async def is_subscribed(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Checks if the user is a member of the force subscribe channel."""
     if not FORCE_SUB_CHANNEL or FORCE_SUB_CHANNEL.strip() == "":
         return True
     
     user_id = update.effective_user.id
+    return await subscription_cache.check(user_id, lambda: fetch_membership(user_id, context))
+
+async def fetch_membership(user_id, context: ContextTypes.DEFAULT_TYPE) -> bool:
     chat_id = FORCE_SUB_CHANNEL if FORCE_SUB_CHANNEL.startswith("@") else f"@{FORCE_SUB_CHANNEL}"
 
     try:
@@ -111,22 +1640,50 @@ async def send_join_message(update: Update):
         except:
             pass
 
-def get_duration(file_path):
-    try:
-        cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", file_path]
-        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return float(result.stdout.strip())
-    except:
-        return 0.0
-
-def extract_thumbnail(video_path, output_thumb):
+def probe_media(file_path):
+    """Runs a single structured ffprobe pass. Returns None if the probe fails."""
     try:
-        cmd = ["ffmpeg", "-i", video_path, "-ss", "00:00:01", "-vframes", "1", output_thumb, "-y"]
-        subprocess.run(cmd, check=True)
-        return output_thumb
-    except:
+        cmd = ["ffprobe", "-v", "error", "-print_format", "json", "-show_format", "-show_streams", file_path]
+        with PROBE_SECONDS.time():
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+        data = json.loads(result.stdout)
+    except Exception:
         return None
 
+    info = {
+        'duration': float(data.get('format', {}).get('duration') or 0),
+        'format_name': data.get('format', {}).get('format_name', ''),
+        'audio_streams': 0,
+        'video_streams': 0,
+        'audio_codec': None,
+        'sample_rate': None,
+        'channels': None,
+        'audio_bitrate': None,
+        'sample_fmt': None,
+        'audio_samples': None,
+        'cover_art': False,
+    }
+    for stream in data.get('streams', []):
+        if stream.get('codec_type') == 'audio':
+            info['audio_streams'] += 1
+            if info['audio_codec'] is None:
+                info['audio_codec'] = stream.get('codec_name')
+                info['sample_rate'] = int(stream.get('sample_rate') or 0) or None
+                info['channels'] = stream.get('channels')
+                info['audio_bitrate'] = int(stream.get('bit_rate') or 0) or None
+                info['sample_fmt'] = stream.get('sample_fmt')
+                # The audio's own length is what gets rendered, not the container's
+                if stream.get('duration'):
+                    info['duration'] = float(stream['duration'])
+                if stream.get('duration_ts') and stream.get('time_base') == f"1/{info['sample_rate']}":
+                    info['audio_samples'] = int(stream['duration_ts'])
+        elif stream.get('codec_type') == 'video':
+            if stream.get('disposition', {}).get('attached_pic'):
+                info['cover_art'] = True
+            else:
+                info['video_streams'] += 1
+    return info
+
 # --- HANDLERS ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -168,7 +1725,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "• **Normalize:** Balances the volume levels.\n\n"
         "**4. Compression:**\n"
         "Click '📉 Compress' to quickly reduce file size (Convert to AAC 64kbps).\n\n"
-        "**5. Issues?**\n"
+        "**5. Albums:**\n"
+        "Send several files together (or as an album). One menu controls them all, and you get them back together or as a ZIP.\n\n"
+        "**6. Issues?**\n"
         "If the bot stops, just type /start again."
     )
     await update.message.reply_text(help_text, parse_mode=ParseMode.MARKDOWN)
@@ -205,73 +1764,142 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         return
     
-    # 200MB Limit for standard bot API
-    if file_obj.file_size > 200 * 1024 * 1024: 
-        await message.reply_text("❌ **File too large!**\nMaximum size allowed is 200MB.")
+    if (file_obj.file_size or 0) > MAX_FILE_SIZE_MB * 1024 * 1024:
+        await message.reply_text(f"❌ **File too large!**\nMaximum size allowed is {MAX_FILE_SIZE_MB}MB.")
         return
 
-    status_msg = await message.reply_text("⏳ **Downloading...** Please wait.")
-    
-    try:
-        new_file = await context.bot.get_file(file_obj.file_id)
+    # Albums and files sent in quick succession share one settings panel.
+    # No awaits until the session is stored, so concurrent album updates
+    # see each other.
+    lead = user_sessions.get(user_id)
+    joins_batch = lead and not lead.busy and len(lead.items) < BATCH_MAX_FILES and (
+        (message.media_group_id and message.media_group_id == lead.media_group_id)
+        or time.monotonic() - lead.created < BATCH_WINDOW
+    )
+
+    if joins_batch:
+        unique_id = f"{lead.unique_id}b{len(lead.items)}"
+    else:
         unique_id = f"{user_id}_{int(time.time())}"
-        ext = os.path.splitext(file_name)[1]
-        input_path = os.path.join(TEMP_DIR, f"{unique_id}_input{ext}")
-        
-        await new_file.download_to_drive(input_path)
-        duration = get_duration(input_path)
-
-        user_sessions[user_id] = {
-            'input_file': input_path,
-            'unique_id': unique_id,
-            'original_name': file_name,
-            'duration': duration,
-            'format': 'mp3',
-            'bitrate': '192',
-            'trim_start': 0, 
-            'trim_end': None,
-            'normalize': False, 
-            'bass_boost': False, 
-            '8d_audio': False,
-            'speed': 1.0,
-            'is_video': is_video,
-            'waiting_for_trim': False
-        }
-        
-        await show_main_menu(status_msg)
-        
-    except Exception as e:
-        logger.error(f"Download Error: {e}")
-        await status_msg.edit_text("❌ **Download Failed.** Please try again.")
+    ext = os.path.splitext(file_name)[1]
+
+    # The file itself is only downloaded when it is actually needed, so a
+    # result cache hit never touches it. Audio/video carry their duration.
+    session = Session(
+        user_id=user_id,
+        unique_id=unique_id,
+        file_id=file_obj.file_id,
+        file_unique_id=file_obj.file_unique_id,
+        original_name=file_name,
+        input_path=os.path.join(TEMP_DIR, f"{unique_id}_input{ext}"),
+        duration=float(getattr(file_obj, 'duration', None) or 0),
+        is_video=is_video,
+    )
+    session.file_size = file_obj.file_size or 0
+    storage.place(session)
+    if not storage.admissible(session):
+        await message.reply_text("💾 **Storage Full!**\nThe server is busy with large files. Please try again in a few minutes.")
+        return
+
+    UPLOADS_TOTAL.labels('video' if is_video else 'audio').inc()
+
+    if joins_batch:
+        lead.batch.append(session)
+        user_sessions.save(lead)
+        if lead.menu_message:
+            try:
+                await show_main_menu(lead.menu_message)
+            except Exception as e:
+                logger.debug(f"Batch menu refresh failed: {e}")
+        return
+
+    session.media_group_id = message.media_group_id
+    user_sessions.put(session)
+    session.menu_message = await message.reply_text("⏳ **Loading...** Please wait.")
+    await show_main_menu(session.menu_message)
+
+async def download_input(session, context):
+    """Downloads the session's source file once and probes it."""
+    await storage.reserve(session)
+    async with session.download_lock:
+        if session.input_file:
+            return session.input_file
+        with DOWNLOAD_SECONDS.time():
+            if LOCAL_BOT_API:
+                new_file = await context.bot.get_file(session.file_id, read_timeout=LOCAL_FILE_TIMEOUT)
+                if os.path.isabs(new_file.file_path) and os.path.exists(new_file.file_path):
+                    # Use the server's copy in place; it stays the server's to delete
+                    session.input_file = new_file.file_path
+                    await asyncio.to_thread(ensure_probe, session)
+                    user_sessions.save(session)
+                    return session.input_file
+            else:
+                new_file = await context.bot.get_file(session.file_id)
+            await new_file.download_to_drive(session.input_path)
+        session.input_file = session.input_path
+        await asyncio.to_thread(ensure_probe, session)
+        user_sessions.save(session)
+        return session.input_file
+
+def release_inputs(*sessions):
+    """Deletes downloaded inputs, but never files read in place from a local Bot API server."""
+    cleanup_files(*[s.input_file for s in sessions if s.input_file == s.input_path])
+
+def upload_file(path):
+    """What to pass to send_*: a local Bot API server reads the file itself
+    (PTB sends it as a file:// URI), the cloud API needs the bytes."""
+    return os.path.abspath(path) if LOCAL_BOT_API else open(path, 'rb')
+
+def ensure_probe(session):
+    """Probes the on-disk input once and caches the result in the session."""
+    if not session.probed:
+        session.probe = probe_media(session.input_file)
+        session.probed = True
+        # Telegram's duration is whole seconds; the probe's is exact
+        if session.probe and session.probe['duration']:
+            session.duration = session.probe['duration']
+    return session.probe
 
 async def show_main_menu(message):
     user_id = message.chat.id if hasattr(message, 'chat') else message.from_user.id
-    session = user_sessions.get(user_id, {})
+    session = user_sessions.get(user_id)
     
     if not session:
         await message.edit_text("❌ **Session Expired.**\nPlease upload the file again.")
         return
 
-    type_text = "📹 Video" if session.get('is_video') else "🎵 Audio"
-    dur = session.get('duration', 0)
+    type_text = "📹 Video" if session.is_video else "🎵 Audio"
+    dur = session.duration
     
-    bass_icon = '✅' if session.get('bass_boost') else '❌'
-    norm_icon = '✅' if session.get('normalize') else '❌'
-    eightd_icon = '✅' if session.get('8d_audio') else '❌'
+    bass_icon = '✅' if session.bass_boost else '❌'
+    norm_icon = '✅' if session.normalize else '❌'
+    eightd_icon = '✅' if session.eight_d_audio else '❌'
     
+    if session.batch:
+        items = session.items
+        dur = sum(item.duration for item in items)
+        files_text = (
+            f"📚 Batch: `{len(items)} files`\n"
+            f"⏱ Total Duration: `{f'{int(dur)}s' if all(item.duration for item in items) else 'Unknown'}`\n\n"
+        )
+    else:
+        files_text = (
+            f"📂 File: `{session.original_name}`\n"
+            f"⏱ Duration: `{f'{int(dur)}s' if dur else 'Unknown'}`\n\n"
+        )
+
     text = (
         f"{type_text} **Control Panel**\n"
-        f"📂 File: `{session.get('original_name')}`\n"
-        f"⏱ Duration: `{int(dur)}s`\n\n"
+        f"{files_text}"
         "⚙️ **Current Settings:**\n"
-        f"• Format: `{session.get('format', 'mp3').upper()}` | {session.get('bitrate')}kbps\n"
+        f"• Format: `{session.format.upper()}` | {session.bitrate}kbps\n"
         f"• Effects: Bass: {bass_icon} | Norm: {norm_icon} | 8D: {eightd_icon}\n"
-        f"• Speed: `{session.get('speed', 1.0)}x`\n"
+        f"• Speed: `{session.speed}x`\n"
     )
     
-    if session.get('trim_start') > 0 or session.get('trim_end'):
-        end_t = session.get('trim_end') if session.get('trim_end') else int(dur)
-        text += f"• ✂️ Trim: `{session.get('trim_start')}s` to `{end_t}s`\n"
+    if session.trim_start > 0 or session.trim_end:
+        end_t = session.trim_end if session.trim_end else 'end'
+        text += f"• ✂️ Trim: `{session.trim_start}s` to `{end_t}{'s' if session.trim_end else ''}`\n"
 
     keyboard = [
         [InlineKeyboardButton("📉 Compress (Auto)", callback_data="set_compress"),
@@ -286,9 +1914,15 @@ async def show_main_menu(message):
         [InlineKeyboardButton("⏩ Speed", callback_data="menu_speed"),
          InlineKeyboardButton("⚡ Bitrate", callback_data="menu_bitrate")],
          
+        [InlineKeyboardButton("🎧 Preview", callback_data="preview")],
+
         [InlineKeyboardButton("🚀 START PROCESSING", callback_data="process_start")]
     ]
+    if session.batch:
+        zip_icon = '✅' if session.as_zip else '❌'
+        keyboard.insert(-1, [InlineKeyboardButton(f"📦 Send as ZIP: {zip_icon}", callback_data="toggle_zip")])
     
+    user_sessions.save(session)
     reply_markup = InlineKeyboardMarkup(keyboard)
     
     if hasattr(message, 'edit_text'):
@@ -303,6 +1937,7 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # --- FORCE SUB HANDLER ---
     if data == "check_sub_status":
+        subscription_cache.invalidate(user_id)
         if await is_subscribed(update, context):
             await query.answer("✅ Verified!")
             await query.edit_message_text(
@@ -315,27 +1950,40 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # -------------------------
 
     await query.answer()
+
+    if data.startswith("cancel_job"):
+        _, _, unique_id = data.partition(":")
+        # Buttons sent before job ids were added carry none
+        session = user_sessions.active.get(unique_id) if unique_id else user_sessions.get(user_id)
+        if session and session.user_id == user_id:
+            session.cancelled = True
+            for item in session.items:
+                if item.job:
+                    scheduler.cancel(item.job)
+        return
     
-    if user_id not in user_sessions:
+    session = user_sessions.get(user_id)
+    if not session:
         await query.edit_message_text("❌ **Session Expired.**\nPlease upload the file again.")
         return
 
-    session = user_sessions[user_id]
-
     if data == "toggle_normalize":
-        session['normalize'] = not session['normalize']
+        session.normalize = not session.normalize
         await show_main_menu(query.message)
     elif data == "toggle_bass":
-        session['bass_boost'] = not session['bass_boost']
+        session.bass_boost = not session.bass_boost
         await show_main_menu(query.message)
     elif data == "toggle_8d":
-        session['8d_audio'] = not session['8d_audio']
+        session.eight_d_audio = not session.eight_d_audio
+        await show_main_menu(query.message)
+    elif data == "toggle_zip":
+        session.as_zip = not session.as_zip
         await show_main_menu(query.message)
         
     elif data == "set_compress":
-        session['format'] = 'aac' 
-        session['bitrate'] = '64'
-        session['normalize'] = True 
+        session.format = 'aac' 
+        session.bitrate = '64'
+        session.normalize = True 
         await query.answer("✅ Compression Preset Applied!")
         await show_main_menu(query.message)
         
@@ -356,11 +2004,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Select Playback Speed:", reply_markup=InlineKeyboardMarkup(buttons))
         
     elif data == "menu_trim":
-        session['waiting_for_trim'] = True
-        dur = int(session.get('duration', 0))
+        session.waiting_for_trim = True
+        dur = int(session.duration)
         msg = (
             f"✂️ **Trim Mode**\n"
-            f"Total Duration: {dur} seconds.\n\n"
+            f"Total Duration: {f'{dur} seconds' if dur else 'Unknown'}.\n\n"
             "👇 **Send Start and End time in seconds.**\n"
             "Example:\n"
             "• `0 30` (First 30s)\n"
@@ -370,113 +2018,1046 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(msg, parse_mode=ParseMode.MARKDOWN)
         
     elif data.startswith("set_fmt_"):
-        session['format'] = data.split("_")[2]
+        session.format = data.split("_")[2]
         await show_main_menu(query.message)
     elif data.startswith("set_bit_"):
-        session['bitrate'] = data.split("_")[2]
+        session.bitrate = data.split("_")[2]
         await show_main_menu(query.message)
     elif data.startswith("set_spd_"):
-        session['speed'] = float(data.split("_")[2])
+        session.speed = float(data.split("_")[2])
         await show_main_menu(query.message)
         
     elif data == "back_main":
-        session['waiting_for_trim'] = False
+        session.waiting_for_trim = False
         await show_main_menu(query.message)
         
     elif data == "process_start":
         await process_audio_thread(query, context)
+    elif data == "preview":
+        await send_preview(query, context)
 
 async def process_audio_thread(query, context):
+    session = user_sessions.get(query.from_user.id)
+    if not session or session.processing:
+        # A second tap on START: the first call owns the job and its storage
+        return
+    started = time.monotonic()
+    user_sessions.active[session.unique_id] = session
+    try:
+        rendered = await run_job(query, context)
+    finally:
+        user_sessions.active.pop(session.unique_id, None)
+        # Journal how the job ended; a delivered job's session is already gone
+        user_sessions.save(session)
+        storage.release(*session.items)
+    # Cache hits and refused jobs would skew the latency of real renders
+    if rendered:
+        JOB_SECONDS.observe(time.monotonic() - started)
+
+async def run_job(query, context):
+    """Runs the session's job. Returns True if a render was delivered."""
     user_id = query.from_user.id
     session = user_sessions.get(user_id)
-    
-    await query.edit_message_text("⚙️ **Processing...**\nThis may take a moment.")
-    
-    try:
-        output_path, thumb_path, caption = await asyncio.to_thread(run_ffmpeg_command, session)
-        
-        if thumb_path and os.path.exists(thumb_path):
-            await query.message.reply_audio(
-                audio=open(output_path, 'rb'), 
-                caption=caption, 
-                thumbnail=open(thumb_path, 'rb'), 
-                title=os.path.splitext(session['original_name'])[0], 
-                performer="AudioStudioBot",
-                parse_mode=ParseMode.MARKDOWN
-            )
+
+    if session.batch:
+        return await process_batch(query, context, session)
+    session.processing = True
+    session.cancelled = False
+    user_sessions.save(session, query.message)
+
+    cache_key = result_cache_key(session)
+    cached = result_cache.get(cache_key)
+    if cached:
+        try:
+            await send_cached_result(query, cached)
+            await query.edit_message_text("✅ **Done!**")
+            release_inputs(session)
+            pcm_cache.drop(session)
+            user_sessions.remove(session)
+            return
+        except Exception as e:
+            logger.error(f"Cached Result Error: {e}")
+            result_cache.discard(cache_key)
+
+    async def on_position(position):
+        if position == 0:
+            await query.edit_message_text("⚙️ **Processing...**\nThis may take a moment.", reply_markup=cancel_markup(session))
         else:
-            await query.message.reply_document(
-                document=open(output_path, 'rb'), 
-                caption=caption,
-                parse_mode=ParseMode.MARKDOWN
+            await query.edit_message_text(
+                f"⏳ **Queued...**\nPosition `{position}` in queue.",
+                parse_mode=ParseMode.MARKDOWN, reply_markup=cancel_markup(session)
             )
-            
+
+    async def on_progress(percent, eta):
+        if percent is None:
+            text = "⚙️ **Processing...**\nThis may take a moment."
+        else:
+            text = f"⚙️ **Processing...** `{percent}%`\n⏱ ETA: `{eta}s`"
+        await query.edit_message_text(text, parse_mode=ParseMode.MARKDOWN, reply_markup=cancel_markup(session))
+
+    try:
+        await storage.reserve(session)
+        # Stream unless the file is already on disk or a preview is fetching it.
+        # Trims want a seekable file on disk, and so does a likely -c:a copy
+        # (it needs the probe first).
+        if (STREAM_INGEST and not LOCAL_BOT_API and session.input_file is None and not session.download_lock.locked()
+                and not session.trim_start and not copy_plausible(session)):
+            new_file = await context.bot.get_file(session.file_id)
+            session.file_url = new_file.file_path
+        else:
+            await query.edit_message_text("⏳ **Downloading...** Please wait.")
+            await download_input(session, context)
+    except StorageFullError:
+        await query.edit_message_text("💾 **Storage Full!**\nThe server is busy with large files. Please try again in a few minutes.")
+        session.processing = False
+        return
+    except Exception as e:
+        logger.error(f"Download Error: {e}")
+        await query.edit_message_text("❌ **Download Failed.** Please try again.")
+        session.processing = False
+        return
+
+    try:
+        job = await scheduler.submit(user_id, lambda: render_job(session, on_progress, on_position), on_position,
+                                     cost_model.estimate(session))
+    except QueueFullError:
+        await query.message.reply_text("🚦 **Server Busy!**\nToo many files in queue. Please try again in a few minutes.")
+        session.processing = False
+        await show_main_menu(query.message)
+        return
+
+    session.job = job
+
+    try:
+        output_path, thumb_path, caption = await job.future
+        await query.edit_message_text("📤 **Uploading...**")
+
+        with UPLOAD_SECONDS.time():
+            if thumb_path and os.path.exists(thumb_path):
+                sent = await query.message.reply_audio(
+                    audio=upload_file(output_path), 
+                    caption=caption, 
+                    thumbnail=upload_file(thumb_path), 
+                    title=os.path.splitext(session.original_name)[0], 
+                    performer="AudioStudioBot",
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                cached = {'kind': 'audio', 'file_id': sent.audio.file_id, 'caption': caption}
+            else:
+                sent = await query.message.reply_document(
+                    document=upload_file(output_path), 
+                    caption=caption,
+                    parse_mode=ParseMode.MARKDOWN
+                )
+                cached = {'kind': 'document', 'file_id': sent.document.file_id, 'caption': caption}
+        result_cache.put(cache_key, cached)
+
         await query.edit_message_text("✅ **Done!**")
         
-        cleanup_files(output_path, thumb_path, session['input_file'])
-        del user_sessions[user_id]
-        
+        cleanup_files(output_path, thumb_path)
+        release_inputs(session)
+        pcm_cache.drop(session)
+        user_sessions.remove(session)
+        return True
+
+    except asyncio.CancelledError:
+        if user_sessions.shutting_down:
+            # Stays journaled as processing and is resumed after the restart
+            raise
+        session.processing = False
+        session.job = None
+        await query.message.reply_text("🛑 **Cancelled.**")
+        await show_main_menu(query.message)
+
     except Exception as e:
         logger.error(f"Processing Error: {e}")
         await query.edit_message_text(f"❌ **Processing Failed.**\nError: {str(e)}")
-        cleanup_files(session.get('input_file'))
+        release_inputs(session)
+        session.input_file = None
+        session.processing = False
+        session.job = None
 
-def run_ffmpeg_command(session):
-    input_path = session['input_file']
-    unique_id = session['unique_id']
-    out_fmt = session['format']
-    output_filename = f"processed_{unique_id}.{out_fmt}"
-    output_path = os.path.join(TEMP_DIR, output_filename)
-    thumb_path = None
-    
-    if session['is_video']:
-        thumb_name = f"thumb_{unique_id}.jpg"
-        thumb_path = os.path.join(TEMP_DIR, thumb_name)
-        extracted = extract_thumbnail(input_path, thumb_path)
-        if not extracted: thumb_path = None
-    
-    cmd = ["ffmpeg", "-i", input_path]
-    
-    if session['trim_start'] > 0:
-        cmd.extend(["-ss", str(session['trim_start'])])
-    if session['trim_end']:
-        cmd.extend(["-to", str(session['trim_end'])])
-        
-    af_chain = []
-    if session['speed'] != 1.0: af_chain.append(f"atempo={session['speed']}")
-    if session['bass_boost']: af_chain.append("bass=g=10:f=100:w=0.5")
-    if session['8d_audio']: af_chain.append("apulsator=hz=0.125")
-    if session['normalize']: af_chain.append("dynaudnorm=f=150:g=15")
-        
-    if af_chain: cmd.extend(["-filter:a", ",".join(af_chain)])
-    cmd.extend(["-b:a", f"{session['bitrate']}k"])
-    
-    if session['is_video']:
-        cmd.append("-vn")
+# --- BATCH MODE ---
+# An album (or files sent within BATCH_WINDOW seconds) shares the first
+# file's settings panel. Every file becomes its own scheduler job, so they
+# encode side by side within the worker limit, and the results go back as
+# document albums of up to 10 or a single ZIP.
+BATCH_WINDOW = float(os.getenv("BATCH_WINDOW", 3))
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", 20))
+BATCH_DOWNLOADS = 3
+MEDIA_GROUP_SIZE = 10
+UPLOAD_LIMIT = (2000 if LOCAL_BOT_API else 50) * 1024 * 1024
+
+async def process_batch(query, context, session):
+    user_id = session.user_id
+    items = session.items
+    for item in session.batch:
+        item.apply_settings(session)
+
+    if scheduler.max_pending - len(scheduler.pending) < len(items):
+        await query.message.reply_text("🚦 **Server Busy!**\nToo many files in queue. Please try again in a few minutes.")
+        return
+
+    session.processing = True
+    session.cancelled = False
+    user_sessions.save(session, query.message)
+    done = 0
+    queue_full = False
+    download_slots = asyncio.Semaphore(BATCH_DOWNLOADS)
+
+    async def update_status():
+        await query.edit_message_text(
+            f"⚙️ **Processing batch...** `{done}/{len(items)}` done",
+            parse_mode=ParseMode.MARKDOWN, reply_markup=cancel_markup(session)
+        )
+
+    async def render(item):
+        nonlocal done, queue_full
+        cache_key = result_cache_key(item)
+        cached = None if session.as_zip else result_cache.get(cache_key)
+        if cached and cached['kind'] == 'document':
+            done += 1
+            return {'key': cache_key, 'cached': cached}
+
+        async with download_slots:
+            if session.cancelled:
+                raise asyncio.CancelledError()
+            await download_input(item, context)
+        if session.cancelled:
+            raise asyncio.CancelledError()
+        try:
+            item.job = await scheduler.submit(user_id, lambda: render_job(item), cost=cost_model.estimate(item))
+        except QueueFullError:
+            # The queue filled up while earlier files were downloading; stop the rest
+            queue_full = session.cancelled = True
+            for other in items:
+                if other.job:
+                    scheduler.cancel(other.job)
+            raise
+        output_path, thumb_path, caption = await item.job.future
+        done += 1
+        try:
+            await update_status()
+        except Exception as e:
+            logger.debug(f"Batch status update failed: {e}")
+        return {'key': cache_key, 'output': output_path, 'thumb': thumb_path, 'caption': caption, 'item': item}
+
+    results = []
+    interrupted = False
+    try:
+        await update_status()
+        results = await asyncio.gather(*(render(item) for item in items), return_exceptions=True)
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if queue_full:
+            raise QueueFullError()
+        if session.cancelled:
+            raise asyncio.CancelledError()
+        if errors:
+            raise errors[0]
+
+        await query.edit_message_text("📤 **Uploading...**")
+        # An oversized ZIP falls back to albums
+        with UPLOAD_SECONDS.time():
+            if not (session.as_zip and await send_batch_zip(query, session, results)):
+                await send_batch_album(query, results)
+        await query.edit_message_text("✅ **Done!**")
+
+        release_inputs(*items)
+        pcm_cache.drop(session)
+        user_sessions.remove(session)
+        return True
+
+    except asyncio.CancelledError:
+        if user_sessions.shutting_down:
+            # Stays journaled as processing and is resumed after the restart
+            interrupted = True
+            raise
+        for item in items:
+            if item.job:
+                scheduler.cancel(item.job)
+        await query.message.reply_text("🛑 **Cancelled.**")
+        await show_main_menu(query.message)
+
+    except QueueFullError:
+        await query.message.reply_text("🚦 **Server Busy!**\nToo many files in queue. Please try again in a few minutes.")
+        await show_main_menu(query.message)
+
+    except Exception as e:
+        logger.error(f"Batch Processing Error: {e}")
+        await query.edit_message_text(f"❌ **Processing Failed.**\nError: {str(e)}")
+
+    finally:
+        for result in results:
+            if isinstance(result, dict):
+                cleanup_files(result.get('output'), result.get('thumb'))
+        for item in items:
+            item.job = None
+        if not interrupted:
+            session.processing = False
+
+async def send_batch_album(query, results):
+    for start in range(0, len(results), MEDIA_GROUP_SIZE):
+        chunk = results[start:start + MEDIA_GROUP_SIZE]
+        media = []
+        for result in chunk:
+            if 'cached' in result:
+                media.append(InputMediaDocument(
+                    media=result['cached']['file_id'], caption=result['cached']['caption'], parse_mode=ParseMode.MARKDOWN
+                ))
+            else:
+                media.append(InputMediaDocument(
+                    media=upload_file(result['output']),
+                    caption=result['caption'],
+                    parse_mode=ParseMode.MARKDOWN,
+                    thumbnail=upload_file(result['thumb']) if result['thumb'] and os.path.exists(result['thumb']) else None,
+                ))
+        sent = await query.message.reply_media_group(media=media)
+        for result, message in zip(chunk, sent):
+            if 'output' in result and message.document:
+                result_cache.put(result['key'], {
+                    'kind': 'document', 'file_id': message.document.file_id, 'caption': result['caption']
+                })
+
+async def send_batch_zip(query, session, results):
+    """Sends all outputs as one ZIP. Returns False if it would be too big to upload."""
+    zip_path = os.path.join(TEMP_DIR, f"album_{session.unique_id}.zip")
+    try:
+        await asyncio.to_thread(write_batch_zip, zip_path, results)
+        if os.path.getsize(zip_path) > UPLOAD_LIMIT:
+            return False
+        await query.message.reply_document(
+            document=upload_file(zip_path),
+            filename=f"{os.path.splitext(session.original_name)[0]}_album.zip",
+            caption=f"✅ **Batch Complete**\n📁 `{len(results)}` files as `{session.format.upper()}`",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        return True
+    finally:
+        cleanup_files(zip_path)
+
+def write_batch_zip(zip_path, results):
+    used_names = set()
+    # Audio is already compressed, so store rather than deflate
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_STORED) as archive:
+        for result in results:
+            item = result['item']
+            base = os.path.splitext(item.original_name)[0]
+            name = f"{base}.{item.format}"
+            counter = 1
+            while name in used_names:
+                counter += 1
+                name = f"{base} ({counter}).{item.format}"
+            used_names.add(name)
+            archive.write(result['output'], arcname=name)
+
+async def send_cached_result(query, cached):
+    if cached['kind'] == 'audio':
+        await query.message.reply_audio(
+            audio=cached['file_id'],
+            caption=cached['caption'],
+            parse_mode=ParseMode.MARKDOWN
+        )
     else:
-        cmd.extend(["-map", "0:a", "-map", "0:v?", "-c:v", "copy", "-id3v2_version", "3"])
+        await query.message.reply_document(
+            document=cached['file_id'],
+            caption=cached['caption'],
+            parse_mode=ParseMode.MARKDOWN
+        )
 
-    cmd.extend(["-y", output_path])
-    
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+# --- PREVIEW ---
+# Short, low-bitrate renders of the current effects. They run on their own
+# lane with a lower CPU priority so they never hold up or slow full jobs.
+PREVIEW_SECONDS = float(os.getenv("PREVIEW_SECONDS", 15))
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", 1))
+PREVIEW_NICE = 10
+
+preview_scheduler = TranscodeScheduler("Preview", PREVIEW_WORKERS, MAX_QUEUE)
+
+def preview_window(session):
+    """Returns (start, length) in input seconds for the preview snippet."""
+    span = PREVIEW_SECONDS * session.speed
+    if session.trim_start > 0 or session.trim_end:
+        start = session.trim_start
+    else:
+        start = max(0.0, session.duration / 2 - span / 2)
+    if session.trim_end:
+        span = min(span, session.trim_end - start)
+    return start, span
+
+async def render_preview(session):
+    preview_path = os.path.join(session.work_dir, f"preview_{session.unique_id}.ogg")
+    start, span = preview_window(session)
+    input_path = session.input_file
+    af_chain = build_filter_chain(session)
+    pcm = None
+    if pcm_covers(session, start, start + span):
+        pcm_cache.touch(session)
+        input_path = session.pcm['path']
+        start -= session.pcm['start']
+    else:
+        pcm = plan_pcm(session)
+
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+    if pcm:
+        # Decode the whole cached region once and cut the preview out of it
+        if pcm['start'] > 0:
+            cmd.extend(["-ss", str(pcm['start'])])
+        if pcm['end']:
+            cmd.extend(["-t", str(pcm['end'] - pcm['start'])])
+        af_chain = [f"atrim=start={start - pcm['start']}:duration={span}", "asetpts=PTS-STARTPTS"] + af_chain
+    else:
+        cmd.extend(["-ss", str(start), "-t", str(span)])
+    cmd.extend(["-i", input_path, "-map", "0:a:0", "-vn"])
+    if af_chain: cmd.extend(["-filter:a", ",".join(af_chain)])
+    cmd.extend(["-c:a", "libopus", "-b:a", "48k", "-y", preview_path])
+    if pcm:
+        cmd.extend(pcm_outputs(pcm))
+
+    returncode = None
+    try:
+        returncode, stderr = await run_ffmpeg_process(cmd, span / session.speed, niceness=PREVIEW_NICE)
+    except asyncio.CancelledError:
+        cleanup_files(preview_path)
+        raise
+    finally:
+        if pcm:
+            finish_pcm(session, pcm, returncode == 0)
+    if returncode != 0:
+        cleanup_files(preview_path)
+        raise RuntimeError(ffmpeg_error(stderr))
+    return preview_path
+
+async def send_preview(query, context):
+    user_id = query.from_user.id
+    session = user_sessions.get(user_id)
+    if session.previewing:
+        return
+    session.previewing = True
+
+    status_msg = await query.message.reply_text("🎧 **Rendering preview...**")
+    preview_path = None
+    try:
+        await download_input(session, context)
+        job = await preview_scheduler.submit(user_id, lambda: render_preview(session))
+        preview_path = await job.future
+        await query.message.reply_voice(voice=upload_file(preview_path), caption="🎧 Preview with current settings")
+        await status_msg.delete()
+    except QueueFullError:
+        await status_msg.edit_text("🚦 **Server Busy!**\nPlease try the preview again in a moment.")
+    except StorageFullError:
+        await status_msg.edit_text("💾 **Storage Full!**\nPlease try the preview again in a few minutes.")
+    except Exception as e:
+        logger.error(f"Preview Error: {e}")
+        await status_msg.edit_text("❌ **Preview Failed.**")
+    finally:
+        cleanup_files(preview_path)
+        session.previewing = False
+        if not session.processing:
+            storage.release(session)
+
+EIGHT_D_HZ = 0.125
+
+def build_filter_chain(session, offset=0.0):
+    """`offset` is where the rendered audio starts in the output timeline,
+    so a chunk of a segmented render picks up the 8D rotation mid-cycle."""
+    af_chain = []
+    if session.speed != 1.0: af_chain.append(f"atempo={session.speed}")
+    if session.bass_boost: af_chain.append("bass=g=10:f=100:w=0.5")
+    if session.eight_d_audio:
+        if offset:
+            phase = (offset * EIGHT_D_HZ) % 1
+            af_chain.append(f"apulsator=hz={EIGHT_D_HZ}:offset_l={phase:.6f}:offset_r={(phase + 0.5) % 1:.6f}")
+        else:
+            af_chain.append(f"apulsator=hz={EIGHT_D_HZ}")
+    if session.normalize: af_chain.append("dynaudnorm=f=150:g=15")
+    return af_chain
+
+def cover_art_args(session, input_index=0):
+    """Maps embedded cover art from an audio source into formats that hold it."""
+    if session.is_video or session.format not in COVER_ART_FORMATS:
+        return ["-vn"]
+    args = ["-map", f"{input_index}:v?", "-c:v", "copy"]
+    if session.format == 'mp3':
+        args.extend(["-id3v2_version", "3"])
+    elif session.format == 'm4a':
+        args.extend(["-disposition:v", "attached_pic"])
+    return args
+
+# Source codecs that each output container can take without re-encoding
+COPY_COMPATIBLE = {
+    'mp3': ('mp3',),
+    'm4a': ('aac', 'alac'),
+    'aac': ('aac',),
+    'ogg': ('vorbis', 'opus'),
+    'flac': ('flac',),
+    'wav': ('pcm_s16le', 'pcm_s24le', 'pcm_s32le', 'pcm_f32le', 'pcm_u8'),
+}
+LOSSLESS_FORMATS = ('wav', 'flac')
+# Audio codecs an upload's container usually holds, to guess before the
+# download whether a copy is possible. Other containers are re-encoded.
+CONTAINER_CODECS = {
+    '.mp3': ('mp3',), '.m4a': ('aac', 'alac'), '.mp4': ('aac',), '.mov': ('aac',), '.aac': ('aac',),
+    '.ogg': ('vorbis', 'opus'), '.webm': ('opus', 'vorbis'), '.flac': ('flac',), '.wav': COPY_COMPATIBLE['wav'],
+}
+
+def copy_plausible(session):
+    """True if the render might stream-copy the source audio, judged from its name alone."""
+    if build_filter_chain(session):
+        return False
+    likely = CONTAINER_CODECS.get(os.path.splitext(session.original_name)[1].lower(), ())
+    return any(codec in COPY_COMPATIBLE.get(session.format, ()) for codec in likely)
+
+def can_stream_copy(session, probe):
+    """True when the probed source audio can go into the output untouched."""
+    if not probe or build_filter_chain(session):
+        return False
+    if probe['audio_codec'] not in COPY_COMPATIBLE.get(session.format, ()):
+        return False
+    if session.format in LOSSLESS_FORMATS:
+        return True
+    # Only copy a lossy stream if it doesn't exceed the bitrate asked for
+    source_bitrate = probe['audio_bitrate']
+    return bool(source_bitrate) and source_bitrate <= int(session.bitrate) * 1000 * 1.05
+
+def build_ffmpeg_command(session, input_spec, output_path, thumb_path=None, copy_audio=False):
+    cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error"]
+
+    # Input seeking: jump straight to the trim point instead of decoding up to it.
+    # -t is an input option too, so it counts source seconds rather than
+    # output seconds after atempo.
+    if session.trim_start > 0:
+        cmd.extend(["-ss", str(session.trim_start)])
+    if session.trim_end:
+        cmd.extend(["-t", str(session.trim_end - session.trim_start)])
+    cmd.extend(["-i", input_spec])
+
+    if copy_audio:
+        cmd.extend(["-c:a", "copy"])
+    else:
+        af_chain = build_filter_chain(session)
+        if af_chain: cmd.extend(["-filter:a", ",".join(af_chain)])
+        cmd.extend(["-b:a", f"{session.bitrate}k"])
     
-    if result.returncode != 0:
-        # Fallback simple conversion if complex filters fail
-        simple_cmd = ["ffmpeg", "-i", input_path, "-vn"]
-        simple_cmd.extend(["-b:a", f"{session['bitrate']}k", "-y", output_path])
-        subprocess.run(simple_cmd, check=True)
+    cmd.extend(["-map", "0:a:0"])
+    cmd.extend(cover_art_args(session))
+    cmd.extend(["-y", output_path])
+
+    if thumb_path:
+        # Second output of the same demux pass instead of a separate ffmpeg run
+        cmd.extend(["-map", "0:v:0", "-ss", "00:00:01", "-frames:v", "1", "-y", thumb_path])
+    return cmd
+
+async def run_ffmpeg_command(session, on_progress=None):
+    """Renders the session's output. Returns (output_path, thumb_path, caption)."""
+    with ENCODE_SECONDS.labels(session.format, effects_label(session)).time():
+        return await render_output(session, on_progress)
+
+async def render_output(session, on_progress=None, measure=True):
+    unique_id = session.unique_id
+    out_fmt = session.format
+    output_filename = f"processed_{unique_id}.{out_fmt}"
+    output_path = os.path.join(session.work_dir, output_filename)
+    thumb_path = None
+
+    if session.input_file is None:
+        thumb_path = await stream_ffmpeg_command(session, output_path, on_progress)
+        if thumb_path is not False:
+            return output_path, thumb_path, build_caption(session)
+        thumb_path = None
+
+    input_path = session.input_file
+    probe = await asyncio.to_thread(ensure_probe, session)
+
+    # Decide up front what the input supports instead of retrying on failure
+    if probe and not probe['audio_streams']:
+        raise ValueError("No audio stream found in this file.")
+    if session.is_video and (probe is None or probe['video_streams']):
+        thumb_path = os.path.join(session.work_dir, f"thumb_{unique_id}.jpg")
+
+    copy_audio = can_stream_copy(session, probe)
+    view = None if copy_audio else pcm_view(session)
+    if view:
+        pcm_cache.touch(session)
+        output_path, _, caption = await render_output(view, on_progress, measure=False)
+        thumb_path = session.pcm['thumb']
+        return output_path, thumb_path if thumb_path and os.path.exists(thumb_path) else None, caption
+    if not copy_audio and can_segment(session, probe):
+        if await run_segmented(session, probe, output_path, thumb_path, on_progress):
+            return output_path, thumb_path, build_caption(session)
+
+    cmd = build_ffmpeg_command(session, input_path, output_path, thumb_path, copy_audio)
+    started = time.monotonic()
+    try:
+        returncode, stderr = await run_ffmpeg_process(cmd, expected_duration(session), on_progress)
+    except asyncio.CancelledError:
+        cleanup_files(output_path, thumb_path)
+        raise
+    if returncode != 0:
+        cleanup_files(output_path, thumb_path)
+        raise RuntimeError(ffmpeg_error(stderr))
+    if measure and not copy_audio:
+        cost_model.record(session, time.monotonic() - started)
 
-    caption = (
+    return output_path, thumb_path, build_caption(session)
+
+def ffmpeg_error(stderr):
+    lines = [line for line in (stderr or '').strip().splitlines() if line.strip()]
+    return lines[-1] if lines else "ffmpeg failed"
+
+def build_caption(session):
+    return (
         f"✅ **Conversion Complete**\n"
-        f"📁 Format: `{out_fmt.upper()}`\n"
-        f"📉 Bitrate: `{session['bitrate']}kbps`"
+        f"📁 Format: `{session.format.upper()}`\n"
+        f"📉 Bitrate: `{session.bitrate}kbps`"
     )
-    
-    return output_path, thumb_path, caption
+
+# --- PCM CACHE ---
+# Optional (PCM_CACHE=1). The first preview of an upload decodes the
+# session's audio (only the trimmed region, if a trim is set) once and
+# writes it to a WAV in TEMP_DIR, together with the video thumbnail, as
+# extra outputs of the same ffmpeg run; the preview is cut from that
+# decode. Later previews and renders that fall inside that region read
+# the WAV instead of decoding and demuxing the source again. Caches of idle sessions are
+# evicted, least recently used first, to stay under PCM_CACHE_MAX_BYTES,
+# and every cache goes away with its session's files.
+PCM_CACHE = os.getenv("PCM_CACHE", "0") == "1"
+PCM_CACHE_MAX_BYTES = int(os.getenv("PCM_CACHE_MAX_BYTES", 2 * 1024 ** 3))
+LOSSLESS_CODECS = ('flac', 'alac', 'wavpack', 'ape', 'tta', 'truehd', 'mlp')
+
+class PcmCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.sessions = OrderedDict()  # unique_id -> session, least recently used first
+        self.hits = 0
+        self.evicted = 0
+
+    def _prune(self):
+        # Session expiry deletes the WAV without telling us
+        for uid, session in list(self.sessions.items()):
+            if not session.pcm or not os.path.exists(session.pcm['path']):
+                session.pcm = None
+                del self.sessions[uid]
+
+    def usage(self):
+        self._prune()
+        return sum(session.pcm['size'] for session in self.sessions.values())
+
+    def reserve(self, session, size):
+        """Evicts other idle sessions' caches until `size` more bytes fit."""
+        if size > self.max_bytes:
+            return False
+        self.drop(session)
+        used = self.usage()
+        for other in list(self.sessions.values()):
+            if used + size <= self.max_bytes:
+                break
+            if not other.busy:
+                used -= other.pcm['size']
+                self.drop(other)
+                self.evicted += 1
+        return used + size <= self.max_bytes
+
+    def add(self, session, pcm):
+        session.pcm = pcm
+        self.sessions[session.unique_id] = session
+
+    def touch(self, session):
+        self.hits += 1
+        if session.unique_id in self.sessions:
+            self.sessions.move_to_end(session.unique_id)
+
+    def drop(self, session):
+        if session.pcm:
+            cleanup_files(session.pcm['path'], session.pcm['thumb'])
+            session.pcm = None
+        self.sessions.pop(session.unique_id, None)
+
+    def stats(self):
+        return {
+            'enabled': PCM_CACHE,
+            'entries': len(self.sessions),
+            'bytes': self.usage(),
+            'limit': self.max_bytes,
+            'hits': self.hits,
+            'evicted': self.evicted,
+        }
+
+pcm_cache = PcmCache(PCM_CACHE_MAX_BYTES)
+
+def pcm_format(probe):
+    """PCM codec and bytes per sample that hold the decoded source losslessly."""
+    codec = probe['audio_codec'] or ''
+    sample_fmt = probe.get('sample_fmt') or ''
+    # Lossy decoders hand 16-bit material to the encoder anyway
+    if not (codec.startswith('pcm_') or codec in LOSSLESS_CODECS) or sample_fmt.startswith(('s16', 'u8')):
+        return 'pcm_s16le', 2
+    if sample_fmt.startswith(('flt', 'dbl')):
+        return 'pcm_f32le', 4
+    return 'pcm_s24le', 3
+
+def pcm_covers(session, start, end):
+    """True if the session's cached PCM holds input seconds `start` to `end` (None: end of file)."""
+    pcm = session.pcm
+    if not pcm or not os.path.exists(pcm['path']) or start < pcm['start']:
+        return False
+    return pcm['end'] is None or (end is not None and end <= pcm['end'])
+
+def pcm_view(session):
+    """A copy of the session that renders from its cached PCM, or None."""
+    if not pcm_covers(session, session.trim_start, session.trim_end):
+        return None
+    probe = session.probe
+    # Cover art only lives in the source file
+    if not session.is_video and session.format in COVER_ART_FORMATS and probe.get('cover_art'):
+        return None
+    pcm = session.pcm
+    view = Session.from_job(session.to_job())
+    view.input_file = pcm['path']
+    view.is_video = False
+    view.pcm = None
+    view.trim_start = session.trim_start - pcm['start']
+    view.trim_end = session.trim_end - pcm['start'] if session.trim_end else None
+    view.duration = (pcm['end'] or session.duration) - pcm['start']
+    view.probe = dict(probe, duration=view.duration, audio_codec=pcm['codec'], audio_bitrate=None,
+                      audio_samples=None, video_streams=0, cover_art=False)
+    view.probed = True
+    return view
+
+def plan_pcm(session):
+    """Prepares caching the session's current region as an extra output of
+    the decode about to run. Returns the cache entry for pcm_outputs() and
+    finish_pcm(), or None if there is nothing to cache or no room."""
+    start, end = session.trim_start, session.trim_end
+    probe = session.probe
+    if (not PCM_CACHE or session.processing or not session.input_file or not probe or not probe['sample_rate']
+            or not probe['audio_streams'] or pcm_covers(session, start, end)):
+        return None
+    codec, width = pcm_format(probe)
+    length = (end or session.duration) - start
+    size = int(length * probe['sample_rate'] * (probe['channels'] or 2) * width)
+    if not pcm_cache.reserve(session, size) or not storage.reserve_pcm(session, size):
+        return None
+    uid = session.unique_id
+    return {
+        'path': os.path.join(TEMP_DIR, f"pcm_{uid}.wav"),
+        'thumb': os.path.join(TEMP_DIR, f"pcmthumb_{uid}.jpg") if session.is_video and probe['video_streams'] else None,
+        'start': start, 'end': end, 'codec': codec, 'size': size,
+    }
+
+def pcm_outputs(pcm):
+    """ffmpeg output arguments that write the cache entry from input 0,
+    which must be read from pcm['start'] to pcm['end']."""
+    args = ["-map", "0:a:0", "-vn", "-c:a", pcm['codec'], "-rf64", "auto", "-y", pcm['path']]
+    if pcm['thumb']:
+        args.extend(["-map", "0:v:0", "-ss", "00:00:01", "-frames:v", "1", "-y", pcm['thumb']])
+    return args
+
+def finish_pcm(session, pcm, ok):
+    storage.release_pcm(session)
+    lead = user_sessions.owner(session)
+    if not ok or lead is None or lead.processing:
+        # Failed, or the job started or the session went away while we decoded
+        cleanup_files(pcm['path'], pcm['thumb'])
+        return
+    pcm_cache.add(session, dict(pcm, size=os.path.getsize(pcm['path'])))
+    user_sessions.save(session)
+
+# --- FFMPEG PROCESS ---
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 5))
+
+def expected_duration(session):
+    """Length of the output in seconds (0 if unknown), used for progress."""
+    end = session.trim_end or session.duration
+    span = max(0.0, float(end or 0) - session.trim_start)
+    return span / session.speed
+
+async def run_ffmpeg_process(cmd, total, on_progress=None, feed=None, niceness=0):
+    """Runs ffmpeg without blocking the loop and returns (returncode, stderr).
+
+    Progress from `-progress pipe:1` is reported to `on_progress(percent,
+    eta)` at most every PROGRESS_INTERVAL seconds; both are None when the
+    output length is unknown. `feed`, if given, is awaited with ffmpeg's
+    stdin. `niceness` lowers the process' CPU priority. Cancelling the
+    calling task kills the process.
+    """
+    cmd = cmd[:1] + ["-progress", "pipe:1", "-nostats"] + cmd[1:]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.PIPE if feed else asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        preexec_fn=(lambda: os.nice(niceness)) if niceness else None,
+    )
+    FFMPEG_ACTIVE.inc()
+    started = time.monotonic()
+
+    async def read_progress():
+        last_report = started
+        async for raw in proc.stdout:
+            key, _, value = raw.decode(errors='ignore').strip().partition('=')
+            if key != 'out_time_us' or not on_progress:
+                continue
+            now = time.monotonic()
+            if now - last_report < PROGRESS_INTERVAL:
+                continue
+            last_report = now
+            percent = eta = None
+            try:
+                done = int(value) / 1_000_000
+            except ValueError:
+                continue
+            if total and done > 0:
+                percent = min(99, int(done * 100 / total))
+                eta = int((now - started) * (total - done) / done)
+            try:
+                await on_progress(percent, eta)
+            except Exception as e:
+                logger.debug(f"Progress update failed: {e}")
+
+    stderr_task = asyncio.create_task(proc.stderr.read())
+    progress_task = asyncio.create_task(read_progress())
+    try:
+        if feed:
+            await feed(proc.stdin)
+        await progress_task
+        returncode = await proc.wait()
+        stderr = (await stderr_task).decode(errors='ignore')
+    except BaseException:
+        # Cancelled by the user or the download broke: don't leave ffmpeg running
+        if proc.returncode is None:
+            proc.kill()
+        await proc.wait()
+        raise
+    finally:
+        FFMPEG_ACTIVE.dec()
+        progress_task.cancel()
+        stderr_task.cancel()
+    return returncode, stderr
+
+# --- SEGMENTED ENCODING ---
+# Long inputs are cut into sample-aligned chunks that are decoded, filtered
+# and (for WAV/FLAC) encoded on separate cores, then joined without
+# re-encoding. Lossy encoders add priming and padding at every file
+# boundary, so for MP3/AAC/OGG the chunks are rendered to FLAC in parallel
+# and encoded once at the end. atempo and dynaudnorm depend on the signal
+# across any cut, so jobs using them stay single-pass. bass gets a short
+# pre-roll to settle its filter state and apulsator carries its phase over.
+SEGMENT_MIN_DURATION = float(os.getenv("SEGMENT_MIN_DURATION", 1200))
+SEGMENT_MIN_LENGTH = 60
+SEGMENT_PRE_ROLL = 1.0
+
+def can_segment(session, probe):
+    if not probe or not probe['sample_rate']:
+        return False
+    if session.speed != 1.0 or session.normalize:
+        return False
+    if expected_duration(session) < SEGMENT_MIN_DURATION:
+        return False
+    # Without filters a lossy target would only move its single encode around
+    return session.format in LOSSLESS_FORMATS or bool(build_filter_chain(session))
+
+def claim_segments(session):
+    """How many chunks to encode at once: the slot this job holds plus idle
+    slots borrowed from the scheduler, which the caller must give back."""
+    by_length = int(expected_duration(session) // SEGMENT_MIN_LENGTH)
+    wanted = max(1, min(os.cpu_count() or 1, by_length))
+    return 1 + scheduler.borrow(wanted - 1)
+
+def count_samples(file_path):
+    cmd = [
+        "ffprobe", "-v", "error", "-select_streams", "a:0", "-show_entries", "stream=duration_ts",
+        "-of", "default=noprint_wrappers=1:nokey=1", file_path,
+    ]
+    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    try:
+        return int(result.stdout.strip())
+    except ValueError:
+        return None
+
+async def run_segmented(session, probe, output_path, thumb_path=None, on_progress=None):
+    """Renders the job in parallel chunks. Returns False if it fell through."""
+    count = claim_segments(session)
+    if count < 2:
+        return False
+
+    rate = probe['sample_rate']
+    total = probe.get('audio_samples') or int(round((probe['duration'] or session.duration) * rate))
+    first = int(round(session.trim_start * rate))
+    last = min(int(round(session.trim_end * rate)), total) if session.trim_end else total
+    bounds = [first + (last - first) * i // count for i in range(count + 1)]
+    pre_roll = int(SEGMENT_PRE_ROLL * rate) if build_filter_chain(session) else 0
+
+    lossless = session.format in LOSSLESS_FORMATS
+    uid = session.unique_id
+    seg_paths = [
+        os.path.join(session.work_dir, f"seg{i}_{uid}.{session.format if lossless else 'flac'}") for i in range(count)
+    ]
+    list_path = os.path.join(session.work_dir, f"concat_{uid}.txt")
+
+    # Chunks account for all of the progress bar, or half when a final encode follows
+    share = 100 if lossless else 50
+    progress = [0] * count
+
+    async def report(percent, eta):
+        if on_progress:
+            await on_progress(min(99, percent), eta)
+
+    def segment_command(i):
+        start, end = bounds[i], bounds[i + 1]
+        read_from = max(first, start - pre_roll)
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error",
+            "-ss", f"{read_from / rate:.6f}", "-t", f"{(end - read_from) / rate:.6f}", "-i", session.input_file,
+            "-map", "0:a:0", "-vn",
+        ]
+        af_chain = build_filter_chain(session, offset=(read_from - first) / rate)
+        af_chain.append(f"atrim=start_sample={start - read_from}")
+        cmd.extend(["-filter:a", ",".join(af_chain)])
+        if not lossless:
+            cmd.extend(["-c:a", "flac", "-sample_fmt", "s32"])
+        cmd.extend(["-y", seg_paths[i]])
+        if i == 0 and thumb_path:
+            cmd.extend(["-map", "0:v:0", "-ss", "00:00:01", "-frames:v", "1", "-y", thumb_path])
+        return cmd
+
+    async def run_segment(i):
+        async def segment_progress(percent, eta):
+            progress[i] = percent or 0
+            await report(sum(progress) * share // (100 * count), eta)
+        return await run_ffmpeg_process(segment_command(i), (bounds[i + 1] - bounds[i]) / rate, segment_progress)
+
+    async def final_progress(percent, eta):
+        await report(share + (percent or 0) * (100 - share) // 100, eta)
+
+    try:
+        try:
+            results = await asyncio.gather(*(run_segment(i) for i in range(count)))
+        finally:
+            # The join below is a single ffmpeg again
+            scheduler.give_back(count - 1)
+        errors = [stderr for returncode, stderr in results if returncode != 0]
+        if errors:
+            raise RuntimeError(ffmpeg_error(errors[0]))
+
+        # Every chunk must hold exactly its share of samples for a gapless join
+        expected = [bounds[i + 1] - bounds[i] for i in range(count)]
+        actual = await asyncio.gather(*(asyncio.to_thread(count_samples, path) for path in seg_paths))
+        if list(actual) != expected:
+            logger.warning(f"Segment sizes {actual} != {expected}, falling back to single-pass")
+            return False
+
+        with open(list_path, 'w') as f:
+            for path in seg_paths:
+                f.write(f"file '{os.path.abspath(path)}'\n")
+        cmd = ["ffmpeg", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", list_path]
+        if not session.is_video and session.format in COVER_ART_FORMATS:
+            cmd.extend(["-i", session.input_file])
+        cmd.extend(["-map", "0:a:0"])
+        cmd.extend(["-c:a", "copy"] if lossless else ["-b:a", f"{session.bitrate}k"])
+        cmd.extend(cover_art_args(session, input_index=1))
+        cmd.extend(["-y", output_path])
+        returncode, stderr = await run_ffmpeg_process(cmd, expected_duration(session), final_progress)
+        if returncode != 0:
+            raise RuntimeError(ffmpeg_error(stderr))
+        return True
+    except BaseException:
+        cleanup_files(output_path, thumb_path)
+        raise
+    finally:
+        cleanup_files(list_path, *seg_paths)
+
+# --- STREAMING INGEST ---
+# Pipes the Telegram download straight into ffmpeg's stdin so decoding
+# overlaps the transfer and the input never lands in TEMP_DIR. MP4-family
+# files whose index (moov) sits after the media data need seeking, so those
+# are spooled to disk and handled by the regular path instead.
+STREAM_INGEST = os.getenv("STREAM_INGEST", "1") == "1"
+STREAM_CHUNK_SIZE = 256 * 1024
+# First box of an MP4/M4A/MOV/3GP file; old QuickTime files may skip ftyp.
+# Names can't be trusted: uploads without one are called "audio.mp3".
+MP4_LEAD_BOXES = (b'ftyp', b'moov', b'mdat', b'wide', b'free', b'skip')
+
+def needs_seeking(head):
+    """Returns True if `head` starts an MP4-family file whose box layout
+    doesn't show moov before mdat."""
+    if head[4:8] not in MP4_LEAD_BOXES:
+        return False
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], 'big')
+        box_type = head[offset + 4:offset + 8]
+        if box_type == b'moov':
+            return False
+        if box_type == b'mdat':
+            return True
+        if size == 1 and offset + 16 <= len(head):
+            size = int.from_bytes(head[offset + 8:offset + 16], 'big')
+        if size < 8:
+            break
+        offset += size
+    return True
+
+async def spool_to_disk(session, chunks, head=b''):
+    with open(session.input_path, 'wb') as f:
+        f.write(head)
+        async for chunk in chunks:
+            f.write(chunk)
+    session.input_file = session.input_path
+
+async def stream_ffmpeg_command(session, output_path, on_progress=None):
+    """Encodes straight from the download stream.
+
+    Returns the thumbnail path (or None) on success. Returns False when the
+    stream couldn't be used; by then the source is on disk in `input_file`.
+    """
+    thumb_path = None
+    if session.is_video:
+        thumb_path = os.path.join(session.work_dir, f"thumb_{session.unique_id}.jpg")
+
+    async with httpx.AsyncClient(timeout=60) as client:
+        async with client.stream("GET", session.file_url) as response:
+            response.raise_for_status()
+            chunks = response.aiter_bytes(STREAM_CHUNK_SIZE)
+            try:
+                head = await chunks.__anext__()
+            except StopAsyncIteration:
+                head = b''
+
+            if needs_seeking(head):
+                await spool_to_disk(session, chunks, head)
+                return False
+
+            async def feed(stdin):
+                try:
+                    stdin.write(head)
+                    async for chunk in chunks:
+                        stdin.write(chunk)
+                        await stdin.drain()
+                    stdin.close()
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+
+            cmd = build_ffmpeg_command(session, "pipe:0", output_path, thumb_path)
+            try:
+                returncode, _ = await run_ffmpeg_process(cmd, expected_duration(session), on_progress, feed)
+            except asyncio.CancelledError:
+                cleanup_files(output_path, thumb_path)
+                raise
+
+        if returncode == 0:
+            return thumb_path
+
+        # The stream is spent; fetch the file and let the on-disk path retry
+        cleanup_files(output_path, thumb_path)
+        async with client.stream("GET", session.file_url) as response:
+            response.raise_for_status()
+            await spool_to_disk(session, response.aiter_bytes(STREAM_CHUNK_SIZE))
+    return False
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
-    if user_id in user_sessions and user_sessions[user_id].get('waiting_for_trim'):
+    session = user_sessions.get(user_id)
+    if session and session.waiting_for_trim:
         text = update.message.text.strip()
         cleaned = re.sub(r'[^\d\s]', ' ', text)
         parts = cleaned.split()
@@ -485,20 +3066,20 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if len(parts) == 2:
                 start, end = int(parts[0]), int(parts[1])
                 if start == 0 and end == 0:
-                    user_sessions[user_id]['trim_start'] = 0
-                    user_sessions[user_id]['trim_end'] = None
+                    session.trim_start = 0
+                    session.trim_end = None
                     await update.message.reply_text("🔄 **Trim Cancelled.**")
                 elif start >= end and end != 0:
                      await update.message.reply_text("❌ Start time must be less than End time.")
                      return
                 else:
-                    user_sessions[user_id]['trim_start'] = start
-                    user_sessions[user_id]['trim_end'] = end
+                    session.trim_start = start
+                    session.trim_end = end
                     await update.message.reply_text(f"✅ Trim Set: `{start}s` to `{end}s`", parse_mode=ParseMode.MARKDOWN)
             else:
                 raise ValueError("Not enough numbers")
                 
-            user_sessions[user_id]['waiting_for_trim'] = False
+            session.waiting_for_trim = False
             await show_main_menu(update.message)
             
         except ValueError:
@@ -510,18 +3091,213 @@ def cleanup_files(*files):
             if f and os.path.exists(f): os.remove(f)
         except Exception: pass
 
+def restore_sessions():
+    """Rebuilds journaled sessions. Returns (session, chat_id, message_id) for
+    each job the last shutdown interrupted."""
+    interrupted = []
+    if not journal:
+        return interrupted
+    for row in journal.load():
+        session = Session.from_journal(row['data'])
+        if row['state'] != 'processing' and time.time() - row['updated_at'] > SESSION_TTL:
+            journal.delete(session)
+            continue
+        for item in session.items:
+            if item.input_file and not os.path.exists(item.input_file):
+                item.input_file = None  # fetched again from file_id when needed
+            if item.pcm and os.path.exists(item.pcm['path']):
+                pcm_cache.add(item, item.pcm)
+            else:
+                item.pcm = None
+        user_sessions.put(session)
+        if row['state'] == 'processing' and row['chat_id'] and row['message_id']:
+            interrupted.append((session, row['chat_id'], row['message_id']))
+    if len(user_sessions):
+        logger.info(f"Restored {len(user_sessions)} sessions, {len(interrupted)} with interrupted jobs")
+    return interrupted
+
+async def resume_job(application, session, chat_id, message_id):
+    """Runs an interrupted job again against its old status message."""
+    bot = application.bot
+    message = Message(message_id, datetime.datetime.now(datetime.timezone.utc), Chat(chat_id, Chat.PRIVATE))
+    message.set_bot(bot)
+    query = CallbackQuery("resume", User(session.user_id, "", False), "", message=message)
+    query.set_bot(bot)
+    try:
+        await query.edit_message_text("♻️ **Bot Restarted!**\nPicking your job back up...")
+    except Exception as e:
+        logger.debug(f"Resume notice failed: {e}")
+    try:
+        await process_audio_thread(query, CallbackContext(application))
+    except Exception as e:
+        logger.error(f"Resume Error: {e}")
+
+async def post_init(application):
+    interrupted = restore_sessions()
+    # Everything in TEMP_DIR that no restored session owns is crash debris
+    removed = user_sessions.sweep_orphans(0)
+    if removed:
+        logger.info(f"Removed {removed} stale files from {TEMP_DIR}")
+    asyncio.create_task(user_sessions.run_sweeper(SWEEP_INTERVAL))
+    await scheduler.start()
+    await preview_scheduler.start()
+    for session, chat_id, message_id in interrupted:
+        asyncio.create_task(resume_job(application, session, chat_id, message_id))
+
+async def on_error(update, context: ContextTypes.DEFAULT_TYPE):
+    HANDLER_ERRORS.inc()
+    logger.error("Unhandled Error", exc_info=context.error)
+
+async def run_bot(application):
+    runner = web.AppRunner(build_web_app(application))
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async with application:
+        await post_init(application)
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                allowed_updates=Update.ALL_TYPES,
+                secret_token=WEBHOOK_SECRET,
+            )
+            logger.info("Receiving updates via webhook")
+        else:
+            await application.bot.delete_webhook()
+            await application.updater.start_polling(allowed_updates=Update.ALL_TYPES)
+            asyncio.create_task(self_ping())
+            logger.info("No WEBHOOK_URL set, polling for updates")
+        await application.start()
+
+        await stop_event.wait()
+        user_sessions.shutting_down = True
+
+        if application.updater.running:
+            await application.updater.stop()
+        await application.stop()
+    await runner.cleanup()
+    result_cache.flush()
+
+async def run_worker():
+    """`python bot.py worker`: renders jobs from JOB_QUEUE until SIGTERM/SIGINT."""
+    if job_queue is None:
+        print("Please set JOB_QUEUE (e.g. sqlite:///jobs.db) to run a worker!")
+        return
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    # claim_segments() borrows idle slots of this worker for parallel encodes
+    scheduler.workers = WORKER_CONCURRENCY
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    running = set()
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    async def work(job_id, payload):
+        session = Session.from_job(payload)
+        progress = {'percent': None, 'eta': None}
+
+        async def on_progress(percent, eta):
+            progress.update(percent=percent, eta=eta)
+
+        scheduler.active += 1
+        task = asyncio.create_task(run_ffmpeg_command(session, on_progress))
+        try:
+            while not task.done():
+                await asyncio.wait({task}, timeout=JOB_HEARTBEAT)
+                if task.done():
+                    break
+                stop = await asyncio.to_thread(job_queue.heartbeat, job_id, worker_id, JOB_VISIBILITY_TIMEOUT,
+                                               progress['percent'], progress['eta'])
+                if stop:
+                    task.cancel()
+            status, result, error = 'done', None, None
+            try:
+                output_path, thumb_path, caption = task.result()
+                result = {'output_path': output_path, 'thumb_path': thumb_path, 'caption': caption}
+            except asyncio.CancelledError:
+                status = 'cancelled'
+            except Exception as e:
+                logger.error(f"Worker Job Error: {e}")
+                status, error = 'failed', str(e)
+            await asyncio.to_thread(job_queue.finish, job_id, worker_id, status, result, error)
+            logger.info(f"Job {job_id} {status}")
+        except Exception as e:
+            # The claim lapses and another worker retries the job
+            logger.error(f"Worker Queue Error: {e}")
+        finally:
+            scheduler.active -= 1
+            slots.release()
+
+    logger.info(f"Worker {worker_id} started: {WORKER_CONCURRENCY} slots")
+    last_purge = 0
+    while not stop_event.is_set():
+        await slots.acquire()
+        if stop_event.is_set():
+            slots.release()
+            break
+        try:
+            if time.monotonic() - last_purge > JOB_RETENTION:
+                await asyncio.to_thread(job_queue.purge, JOB_RETENTION)
+                last_purge = time.monotonic()
+            if scheduler.active + scheduler.borrowed >= scheduler.workers:
+                claimed = None  # a segmented render is using the free slots
+            else:
+                claimed = await asyncio.to_thread(job_queue.claim, worker_id, JOB_VISIBILITY_TIMEOUT)
+        except Exception as e:
+            logger.error(f"Worker Queue Error: {e}")
+            claimed = None
+        if not claimed:
+            slots.release()
+            try:
+                await asyncio.wait_for(stop_event.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        task = asyncio.create_task(work(*claimed))
+        running.add(task)
+        task.add_done_callback(running.discard)
+
+    # Let claimed jobs finish instead of leaving them to the visibility timeout
+    if running:
+        logger.info(f"Waiting for {len(running)} jobs before exiting")
+        await asyncio.gather(*running, return_exceptions=True)
+
 def main():
+    if sys.argv[1:] == ['worker']:
+        asyncio.run(run_worker())
+        return
     if not BOT_TOKEN:
         print("Please set BOT_TOKEN env variable!")
         return
-    start_keep_alive()
-    application = Application.builder().token(BOT_TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .rate_limiter(outbound_limiter)
+        .concurrent_updates(True)
+    )
+    if LOCAL_BOT_API:
+        builder = (
+            builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot")
+            .base_file_url(f"{BOT_API_URL.rstrip('/')}/file/bot")
+            .local_mode(True)
+        )
+    application = builder.build()
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(MessageHandler(filters.AUDIO | filters.VIDEO | filters.Document.ALL, handle_document))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     application.add_handler(CallbackQueryHandler(handle_callback))
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    application.add_error_handler(on_error)
+    asyncio.run(run_bot(application))
 
 if __name__ == '__main__':
     main()